@@ -1,17 +1,30 @@
 import os
+import atexit
+import heapq
+import hmac
 import json
 import logging
+import queue
 import threading
 import time
+import random
 import re
+import socket
+import sys
+import uuid
 import sqlite3
-from datetime import datetime, timedelta
-from collections import defaultdict
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, Future, TimeoutError as FutureTimeoutError, wait as futures_wait
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
+from urllib.request import pathname2url
 from typing import Optional, Dict, Any, List, Tuple
 
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify
 
 # =========================
 # НАСТРОЙКИ
@@ -46,52 +59,1208 @@ ALLOWED_DOMAINS = {
 
 URL_RE = re.compile(r"(https?://\S+)", re.I)
 
+# Write-behind для малоценных записей (last_active): сбрасываем пачкой раз в интервал или по размеру
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "5"))
+WRITE_BEHIND_MAX = int(os.environ.get("WRITE_BEHIND_MAX", "500"))
+
+# Напоминания о возможности подать ссылку
+SUBMIT_COOLDOWN_HOURS = 48
+REMINDER_REPEAT_MINUTES = 60
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", "50"))
+REMINDER_MAX_BATCHES = int(os.environ.get("REMINDER_MAX_BATCHES", "20"))
+
+# Рассылки (напоминания, объявления админа): получатели и прогресс по каждому хранятся в БД,
+# после рестарта или смены лидера отправка продолжается с неотправленных.
+# Кто заблокировал бота (403), помечается и в следующие рассылки не попадает до нового /start.
+# Доставка не чаще одного раза: перед отправкой получатели помечаются sending; если процесс упал,
+# до 2 x BROADCAST_CONCURRENCY таких получателей остаются sending без подтверждения и не переотправляются
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "20"))  # сообщений в очереди outbound одновременно
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "20"))  # сообщений/сек; остаток TG_GLOBAL_RATE - интерактиву
+BROADCAST_FLUSH = int(os.environ.get("BROADCAST_FLUSH", "50"))  # результатов на одну запись прогресса
+BROADCAST_POLL_SECONDS = float(os.environ.get("BROADCAST_POLL_SECONDS", "5"))
+# завершенные/отмененные рассылки и забытые черновики удаляются вместе с получателями через N дней
+BROADCAST_RETENTION_DAYS = float(os.environ.get("BROADCAST_RETENTION_DAYS", "7"))
+
+# Планировщик фоновых задач: как часто перечитывать таблицу jobs (задачи от других воркеров)
+JOB_SYNC_SECONDS = float(os.environ.get("JOB_SYNC_SECONDS", "5"))
+# Разовая задача с ошибкой (дедлайн дуэли) повторяется с экспоненциальной паузой, а не удаляется
+JOB_RETRY_BASE_SECONDS = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "30"))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get("JOB_RETRY_MAX_SECONDS", "900"))
+JOB_MAX_RETRIES = int(os.environ.get("JOB_MAX_RETRIES", "8"))
+
+# Выбор лидера между воркерами gunicorn: фоновые задачи выполняет только держатель аренды
+LEADER_LEASE_TTL = float(os.environ.get("LEADER_LEASE_TTL", "30"))
+# RUN_BACKGROUND=0 - не запускать планировщик и выбор лидера (bench.py, разовые скрипты)
+RUN_BACKGROUND = os.environ.get("RUN_BACKGROUND", "1") == "1"
+
+# Реестр живых дуэлей по message_id: при промахе перечитываем из БД не чаще раза в N секунд
+DUEL_REGISTRY_REFRESH = float(os.environ.get("DUEL_REGISTRY_REFRESH", "5"))
+
+# Long polling (python app.py --poll): альтернатива webhook без публичного HTTPS
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "50"))
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", "100"))
+POLL_DELETE_WEBHOOK = os.environ.get("POLL_DELETE_WEBHOOK", "0") == "1"
+
+# Защита от повторной доставки update: последние update_id в памяти + таблица processed_updates
+DEDUP_MEMORY_SIZE = int(os.environ.get("DEDUP_MEMORY_SIZE", "4096"))
+DEDUP_TTL_SECONDS = float(os.environ.get("DEDUP_TTL_SECONDS", "86400"))
+DEDUP_PRUNE_EVERY = int(os.environ.get("DEDUP_PRUNE_EVERY", "1000"))
+
+# Профилировщик SQL (по умолчанию выключен, включается SQL_PROFILE=1 или /sql_top on):
+# время по нормализованным запросам + лог медленных запросов с EXPLAIN QUERY PLAN
+SQL_PROFILE = os.environ.get("SQL_PROFILE", "0") == "1"
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "50"))
+SQL_PROFILE_MAX_STATEMENTS = int(os.environ.get("SQL_PROFILE_MAX_STATEMENTS", "500"))
+
+# /health без токена не показывает id пользователей (hot_shards, имена задач дуэлей) и хост/pid держателя аренды:
+# они заменяются псевдонимами; HEALTH_TOKEN (?token= или заголовок X-Health-Token) открывает полные данные
+HEALTH_TOKEN = os.environ.get("HEALTH_TOKEN", "").strip()
+
+# Все записи в SQLite делает один поток-писатель: операции из очереди коммитятся пачкой (group commit).
+# WRITER_MAX_WAIT_MS > 0 - подождать еще операций перед COMMIT (больше пачка, выше задержка записи)
+WRITER_MAX_BATCH = int(os.environ.get("WRITER_MAX_BATCH", "64"))
+WRITER_MAX_WAIT_MS = float(os.environ.get("WRITER_MAX_WAIT_MS", "0"))
+
+# Чтения идут через ограниченный пул read-only соединений (mode=ro, query_only), запись - через писателя.
+# Соединение пересоздается по возрасту/числу запросов, простаивавшее проверяется SELECT 1 перед выдачей.
+READ_POOL_SIZE = int(os.environ.get("READ_POOL_SIZE", "8"))
+READ_POOL_TIMEOUT = float(os.environ.get("READ_POOL_TIMEOUT", "10"))
+READ_CONN_MAX_AGE = float(os.environ.get("READ_CONN_MAX_AGE", "600"))
+READ_CONN_MAX_USES = int(os.environ.get("READ_CONN_MAX_USES", "50000"))
+READ_CONN_CHECK_IDLE = float(os.environ.get("READ_CONN_CHECK_IDLE", "30"))
+# кэш подготовленных statements на соединение: ~70 постоянных текстов запросов в Storage
+# + варианты IN (...) по IN_LIST_SIZES; при меньшем размере запросы вытесняют друг друга
+SQLITE_STATEMENT_CACHE = int(os.environ.get("SQLITE_STATEMENT_CACHE", "96"))
+
+# Кэш отображаемых имен пользователей (safe_username)
+USER_NAME_CACHE_SIZE = int(os.environ.get("USER_NAME_CACHE_SIZE", "2048"))
+USER_NAME_CACHE_TTL = float(os.environ.get("USER_NAME_CACHE_TTL", "300"))
+
+# Лидерборд в памяти: как часто сверять его с таблицей balances (другие воркеры тоже меняют балансы)
+LEADERBOARD_VERIFY_INTERVAL = float(os.environ.get("LEADERBOARD_VERIFY_INTERVAL", "60"))
+
+# Очередь входящих updates: webhook только кладет update в очередь и сразу отвечает 200.
+# Updates раскладываются по UPDATE_WORKERS последовательным полосам по id пользователя:
+# разные пользователи обрабатываются параллельно, updates одного пользователя - строго по порядку.
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))  # суммарно на все полосы
+# drop_oldest - выкинуть самый старый update, drop_newest - выкинуть новый,
+# reject - ответить 503, чтобы Telegram доставил update повторно позже
+UPDATE_OVERFLOW = os.environ.get("UPDATE_OVERFLOW", "drop_oldest").strip().lower()
+
+# HTTP-клиент Bot API: keep-alive соединения к api.telegram.org
+# TELEGRAM_API_BASE - другой адрес Bot API (локальный fake_telegram.py, свой telegram-bot-api сервер)
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").strip().rstrip("/")
+TG_POOL_SIZE = int(os.environ.get("TG_POOL_SIZE", "16"))
+
+# Лимиты исходящих сообщений (flood limits Telegram): ~30/сек всего, ~1/сек в личку, ~20/мин в группу
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE_PER_MIN = float(os.environ.get("TG_GROUP_RATE_PER_MIN", "20"))
+TG_CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", "3"))
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", "4"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_WAIT_TIMEOUT = float(os.environ.get("OUTBOUND_WAIT_TIMEOUT", "120"))
+
 if not TELEGRAM_TOKEN:
     logger.error("TELEGRAM_TOKEN пустой. Бот не сможет работать.")
 
+# =========================
+# МЕТРИКИ (Prometheus text format)
+# =========================
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _prom_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{n}="{v}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.series: Dict[Tuple[Any, ...], List[Any]] = {}
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        # счетчики по корзинам без накопления; кумулятивные суммы считаются при выдаче
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            st = self.series.get(label_values)
+            if st is None:
+                st = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            st[0][idx] += 1
+            st[1] += value
+            st[2] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self.series.items()]
+        for values, counts, total, n in items:
+            acc = 0
+            for bound, c in zip(self.buckets, counts):
+                acc += c
+                labels = _prom_labels(self.labels, values, 'le="%g"' % bound)
+                out.append(f"{self.name}_bucket{labels} {acc}")
+            labels = _prom_labels(self.labels, values, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{labels} {n}")
+            out.append(f"{self.name}_sum{_prom_labels(self.labels, values)} {total:.6f}")
+            out.append(f"{self.name}_count{_prom_labels(self.labels, values)} {n}")
+        return out
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, *label_values: Any) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = list(self.values.items())
+        for values, v in items:
+            out.append(f"{self.name}{_prom_labels(self.labels, values)} {v:g}")
+        return out
+
+class GaugeFunc:
+    # значение снимается в момент выдачи /metrics; fn -> [(label_values, value)]
+    # kind="counter" для монотонных счетчиков, которые компоненты уже ведут сами
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], fn, kind: str = "gauge"):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            for values, v in self.fn():
+                out.append(f"{self.name}{_prom_labels(self.labels, tuple(values))} {float(v):g}")
+        except Exception as e:
+            logger.warning(f"metric {self.name} failed: {e}")
+        return out
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Any] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+UPDATE_SECONDS = metrics.add(Histogram("clubbot_update_handle_seconds", "Update handling time by update type and command", ("type", "command")))
+WEBHOOK_SECONDS = metrics.add(Histogram("clubbot_webhook_request_seconds", "Time to accept a webhook request"))
+TG_SECONDS = metrics.add(Histogram("clubbot_tg_request_seconds", "Bot API request latency", ("method",)))
+TG_ERRORS = metrics.add(CounterMetric("clubbot_tg_errors_total", "Bot API calls that failed or returned ok=false", ("method",)))
+SQL_SECONDS = metrics.add(Histogram("clubbot_sqlite_statement_seconds", "SQLite statement time", ("op",)))
+SQL_WRITE_WAIT = metrics.add(Histogram("clubbot_sqlite_write_wait_seconds", "Time from submitting a write to its commit"))
+SQL_WRITE_BATCH = metrics.add(Histogram("clubbot_sqlite_write_batch_size", "Write operations per group commit",
+                                        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)))
+JOB_SECONDS = metrics.add(Histogram("clubbot_job_run_seconds", "Background job run time", ("job",)))
+
+def sql_op(sql: str) -> str:
+    head = sql.lstrip()[:8].split(None, 1)
+    op = head[0].lower() if head else ""
+    return op if op in ("select", "insert", "update", "delete") else "other"
+
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_SQL_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_SQL_SPACE_RE = re.compile(r"\s+")
+
+def normalize_sql(sql: str) -> str:
+    # литералы -> ?, IN (?, ?, ...) любой длины -> IN (...): один ключ на форму запроса
+    s = _SQL_SPACE_RE.sub(" ", sql).strip()
+    s = _SQL_STRING_RE.sub("?", s)
+    s = _SQL_NUMBER_RE.sub("?", s)
+    return _SQL_IN_LIST_RE.sub("IN (...)", s)
+
+class SqlProfiler:
+    SLOW_LOG_EVERY = 60.0  # один и тот же медленный запрос пишем в лог не чаще раза в минуту
+
+    def __init__(self, enabled: bool, slow_ms: float, max_statements: int):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.max_statements = max(1, int(max_statements))
+        self.lock = threading.Lock()
+        self.normalized: Dict[str, str] = {}
+        self.statements: Dict[str, Dict[str, Any]] = {}
+        self.plans: Dict[str, List[str]] = {}
+        self.slow_logged_at: Dict[str, float] = {}
+        self.overflow = 0
+        self.since = time.time()
+
+    def _key(self, sql: str) -> str:
+        key = self.normalized.get(sql)
+        if key is None:
+            key = normalize_sql(sql)
+            if len(self.normalized) >= self.max_statements * 4:
+                self.normalized.clear()
+            self.normalized[sql] = key
+        return key
+
+    def record(self, conn: sqlite3.Connection, sql: str, params: Any, elapsed: float) -> None:
+        elapsed_ms = elapsed * 1000.0
+        slow = elapsed_ms >= self.slow_ms
+        with self.lock:
+            key = self._key(sql)
+            st = self.statements.get(key)
+            if st is None:
+                if len(self.statements) >= self.max_statements:
+                    self.overflow += 1
+                    return
+                st = self.statements[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0}
+            st["count"] += 1
+            st["total_ms"] += elapsed_ms
+            st["max_ms"] = max(st["max_ms"], elapsed_ms)
+            if not slow:
+                return
+            st["slow"] += 1
+            now = time.time()
+            if now - self.slow_logged_at.get(key, 0.0) < self.SLOW_LOG_EVERY:
+                return
+            self.slow_logged_at[key] = now
+            plan = self.plans.get(key)
+        if plan is None:
+            plan = self._explain(conn, sql, params)
+            with self.lock:
+                self.plans[key] = plan
+        logger.warning(f"slow sql {elapsed_ms:.1f}ms: {key} | plan: {'; '.join(plan) or '-'}")
+
+    def _explain(self, conn: sqlite3.Connection, sql: str, params: Any) -> List[str]:
+        if sql_op(sql) == "other":
+            return []
+        try:
+            # мимо Storage._run: план не должен попадать в счетчики и профиль
+            return [str(r[3]) for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        except Exception as e:
+            return [f"explain failed: {e}"]
+
+    def top(self, n: int = 10) -> List[Dict[str, Any]]:
+        with self.lock:
+            items = sorted(self.statements.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)[:max(1, n)]
+            return [{"sql": k, "count": v["count"], "total_ms": round(v["total_ms"], 1),
+                     "avg_ms": round(v["total_ms"] / v["count"], 3), "max_ms": round(v["max_ms"], 1),
+                     "slow": v["slow"], "plan": self.plans.get(k)} for k, v in items]
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statements.clear()
+            self.plans.clear()
+            self.slow_logged_at.clear()
+            self.overflow = 0
+            self.since = time.time()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"enabled": self.enabled, "slow_ms": self.slow_ms, "statements": len(self.statements),
+                    "untracked": self.overflow, "since": datetime.fromtimestamp(self.since).isoformat()}
+
+sql_profiler = SqlProfiler(SQL_PROFILE, SQL_SLOW_MS, SQL_PROFILE_MAX_STATEMENTS)
+
 # =========================
 # STORAGE (SQLite)
 # =========================
 
+def format_display_name(user_id: int, row: Optional[Dict[str, Any]]) -> str:
+    u = row or {}
+    username = u.get("username")
+    if username:
+        return "@" + username
+    name = ((u.get("first_name") or "") + " " + (u.get("last_name") or "")).strip()
+    return name if name else f"пользователь {user_id}"
+
+class DisplayNameCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self.items: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, ids: List[int]) -> Tuple[Dict[int, str], List[int]]:
+        found: Dict[int, str] = {}
+        missing: List[int] = []
+        now = time.monotonic()
+        with self.lock:
+            for uid in ids:
+                item = self.items.get(uid)
+                if item is not None and item[1] > now:
+                    self.items.move_to_end(uid)
+                    found[uid] = item[0]
+                    self.hits += 1
+                else:
+                    missing.append(uid)
+                    self.misses += 1
+        return found, missing
+
+    def put(self, uid: int, name: str) -> None:
+        with self.lock:
+            self.items[uid] = (name, time.monotonic() + self.ttl)
+            self.items.move_to_end(uid)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, uid: int) -> None:
+        with self.lock:
+            self.items.pop(uid, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"size": len(self.items), "capacity": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+# ---- миграции схемы ----
+# Номер последней примененной миграции хранится в meta.schema_version.
+# Шаг миграции - SQL-строка или функция(conn); каждая миграция идет в своей транзакции.
+
+MIGRATIONS: List[Tuple[int, str, List[Any]]] = [
+    (1, "hot-path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_queue_user ON queue(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_user_time ON submissions(user_id, submitted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_duels_status_submissions_deadline ON duels(status, submissions_deadline)",
+        "CREATE INDEX IF NOT EXISTS idx_duels_status_vote_deadline ON duels(status, vote_deadline)",
+        "CREATE INDEX IF NOT EXISTS idx_duels_status_created ON duels(status, created_at)",
+    ]),
+]
+
+def compute_next_reminder_at(last_submit_at: Optional[str], notified_at: Optional[str]) -> Optional[str]:
+    # напоминаем через SUBMIT_COOLDOWN_HOURS после подачи и не чаще раза в REMINDER_REPEAT_MINUTES
+    if not last_submit_at:
+        return None
+    try:
+        due = datetime.fromisoformat(last_submit_at) + timedelta(hours=SUBMIT_COOLDOWN_HOURS)
+    except Exception:
+        return None
+    if notified_at:
+        try:
+            due = max(due, datetime.fromisoformat(notified_at) + timedelta(minutes=REMINDER_REPEAT_MINUTES))
+        except Exception:
+            pass
+    return due.isoformat()
+
+def _backfill_next_reminder_at(conn: sqlite3.Connection) -> None:
+    rows = conn.execute(
+        "SELECT user_id, last_submit_at, submit_notified_at FROM user_state WHERE last_submit_at IS NOT NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE user_state SET next_reminder_at=? WHERE user_id=?",
+        [(compute_next_reminder_at(r[1], r[2]), int(r[0])) for r in rows]
+    )
+
+MIGRATIONS.append((2, "user_state.next_reminder_at", [
+    "ALTER TABLE user_state ADD COLUMN next_reminder_at TEXT",
+    _backfill_next_reminder_at,
+    "CREATE INDEX IF NOT EXISTS idx_user_state_next_reminder ON user_state(next_reminder_at)",
+]))
+
+MIGRATIONS.append((3, "scheduled jobs", [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        name TEXT PRIMARY KEY,
+        handler TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        spec TEXT,
+        payload_json TEXT NOT NULL DEFAULT '{}',
+        next_run REAL NOT NULL,
+        last_run REAL
+    )""",
+]))
+
+MIGRATIONS.append((4, "leader leases", [
+    """CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        acquired_at REAL NOT NULL,
+        heartbeat_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )""",
+]))
+
+def _migrate_duel_json(conn: sqlite3.Connection) -> None:
+    rows = conn.execute("SELECT duel_id, created_at, participants_json, paragraphs_json, votes_json FROM duels").fetchall()
+    for r in rows:
+        try:
+            participants = json.loads(r[2] or "[]")
+            paragraphs = json.loads(r[3] or "{}")
+            votes = json.loads(r[4] or "{}")
+        except Exception:
+            logger.warning(f"duel {r[0]}: broken JSON fields, entries not migrated")
+            continue
+        if not isinstance(participants, list) or not isinstance(paragraphs, dict) or not isinstance(votes, dict):
+            continue
+        conn.executemany(
+            "INSERT OR IGNORE INTO duel_entries(duel_id,user_id,position,text,created_at) VALUES(?,?,?,?,?)",
+            [(r[0], int(uid), i, paragraphs.get(str(uid), ""), r[1]) for i, uid in enumerate(participants, 1)]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO duel_votes(duel_id,voter_id,choice,created_at) VALUES(?,?,?,?)",
+            [(r[0], int(voter), int(choice), r[1]) for voter, choice in votes.items()]
+        )
+
+MIGRATIONS.append((5, "duel entries and votes tables", [
+    """CREATE TABLE IF NOT EXISTS duel_entries (
+        duel_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (duel_id, user_id),
+        UNIQUE (duel_id, position),
+        FOREIGN KEY(duel_id) REFERENCES duels(duel_id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS duel_votes (
+        duel_id TEXT NOT NULL,
+        voter_id INTEGER NOT NULL,
+        choice INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (duel_id, voter_id),
+        FOREIGN KEY(duel_id) REFERENCES duels(duel_id) ON DELETE CASCADE
+    )""",
+    _migrate_duel_json,
+]))
+
+MIGRATIONS.append((6, "processed updates", [
+    """CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        seen_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_processed_updates_seen ON processed_updates(seen_at)",
+]))
+
+def _backfill_quotes_ledger(conn: sqlite3.Connection) -> None:
+    # стартовая запись на текущий баланс: сумма delta по пользователю всегда равна balances.balance
+    now = datetime.now().isoformat()
+    conn.execute(
+        """INSERT INTO quotes_ledger(user_id, delta, balance_after, reason, ref, created_at)
+           SELECT user_id, balance, balance, 'Баланс на момент запуска журнала', NULL, ? FROM balances""",
+        (now,)
+    )
+
+MIGRATIONS.append((7, "append-only quotes ledger", [
+    # без FK на users: удаление пользователя не должно стирать историю движений
+    """CREATE TABLE IF NOT EXISTS quotes_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        balance_after INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        ref TEXT,
+        created_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_quotes_ledger_user ON quotes_ledger(user_id, id)",
+    # ref (daily:<дата>, duel:<id>, ...) - начисление по одному поводу проходит один раз
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_quotes_ledger_ref ON quotes_ledger(ref) WHERE ref IS NOT NULL",
+    """CREATE TRIGGER IF NOT EXISTS quotes_ledger_no_update BEFORE UPDATE ON quotes_ledger
+       BEGIN SELECT RAISE(ABORT, 'quotes_ledger is append-only'); END""",
+    """CREATE TRIGGER IF NOT EXISTS quotes_ledger_no_delete BEFORE DELETE ON quotes_ledger
+       BEGIN SELECT RAISE(ABORT, 'quotes_ledger is append-only'); END""",
+    _backfill_quotes_ledger,
+]))
+
+MIGRATIONS.append((8, "broadcasts", [
+    """CREATE TABLE IF NOT EXISTS broadcasts (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        audience TEXT NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_by INTEGER,
+        created_at TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, created_at)",
+    """CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        updated_at TEXT,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID""",
+    # бот заблокирован пользователем (403): снимается при следующем сообщении от него
+    "ALTER TABLE user_state ADD COLUMN blocked_at TEXT",
+]))
+
+# Получатели рассылок: (выборка user_id, пометка выбранных при создании, запись при доставке).
+# Параметры именованные: :bid - id рассылки, остальные передает создатель рассылки
+BROADCAST_AUDIENCES: Dict[str, Tuple[str, Optional[str], Optional[str]]] = {
+    "all": (
+        """SELECT u.id AS user_id FROM users u
+           LEFT JOIN user_state s ON s.user_id = u.id
+           WHERE s.blocked_at IS NULL""",
+        None,
+        None,
+    ),
+    # выбранным сразу переносим next_reminder_at: следующий запуск задачи их не возьмет повторно
+    "reminders": (
+        """SELECT s.user_id FROM user_state s
+           WHERE s.next_reminder_at <= :now AND s.blocked_at IS NULL
+             AND NOT EXISTS (SELECT 1 FROM queue q WHERE q.user_id = s.user_id)
+           ORDER BY s.next_reminder_at LIMIT :limit""",
+        """UPDATE user_state SET next_reminder_at=:next_at
+           WHERE user_id IN (SELECT user_id FROM broadcast_recipients WHERE broadcast_id=:bid)""",
+        "UPDATE user_state SET submit_notified_at=:at WHERE user_id=:uid",
+    ),
+}
+
+# UPDATE ... RETURNING появился в SQLite 3.35; на более старых - UPDATE и SELECT в той же транзакции писателя
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Тексты запросов горячего пути: одни и те же строки выполняют методы Storage и проверяет --check-schema
+QUERY_QUEUE_HAS_USER = "SELECT 1 FROM queue WHERE user_id=? LIMIT 1"
+QUERY_USER_SUBMISSIONS = """SELECT article_id, url, submitted_at, status
+               FROM submissions
+               WHERE user_id=?
+               ORDER BY submitted_at DESC
+               LIMIT ?"""
+QUERY_DUELS_DUE_WAITING = "SELECT * FROM duels WHERE status='waiting' AND submissions_deadline IS NOT NULL AND submissions_deadline <= ?"
+QUERY_DUELS_DUE_VOTING = "SELECT * FROM duels WHERE status='voting' AND vote_deadline IS NOT NULL AND vote_deadline <= ?"
+QUERY_ACTIVE_DUELS = "SELECT * FROM duels WHERE status IN ('waiting','voting')"
+QUERY_BROADCAST_PENDING = """SELECT user_id FROM broadcast_recipients
+               WHERE broadcast_id=? AND user_id>? AND status='pending' ORDER BY user_id LIMIT ?"""
+
+# Запросы горячего пути, которые --check-schema прогоняет через EXPLAIN QUERY PLAN
+HOT_QUERIES: List[Tuple[str, str, Any]] = [
+    ("queue_has_user", QUERY_QUEUE_HAS_USER, (0,)),
+    ("list_user_submissions", QUERY_USER_SUBMISSIONS, (0, 10)),
+    ("list_duels_due.waiting", QUERY_DUELS_DUE_WAITING, ("",)),
+    ("list_duels_due.voting", QUERY_DUELS_DUE_VOTING, ("",)),
+    ("list_active_duels", QUERY_ACTIVE_DUELS, ()),
+    ("broadcast_audience.reminders", BROADCAST_AUDIENCES["reminders"][0], {"now": "", "limit": 50}),
+    ("list_broadcast_pending", QUERY_BROADCAST_PENDING, ("", 0, 50)),
+]
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT v FROM meta WHERE k='schema_version'").fetchone()
+    return int(row[0]) if row else 0
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    prev_isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, name, steps in MIGRATIONS:
+            # BEGIN IMMEDIATE: несколько воркеров gunicorn стартуют одновременно,
+            # версию перечитываем уже под блокировкой записи
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(
+                    "INSERT INTO meta(k,v) VALUES('schema_version',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+                    (str(version),)
+                )
+                conn.execute("COMMIT")
+                logger.info(f"schema migration {version} applied: {name}")
+            except Exception:
+                conn.execute("ROLLBACK")
+                logger.error(f"schema migration {version} ({name}) failed", exc_info=True)
+                raise
+        return schema_version(conn)
+    finally:
+        conn.isolation_level = prev_isolation
+
+def explain_hot_queries(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    report = []
+    for name, sql, params in HOT_QUERIES:
+        plan = [str(r[3]) for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        # "SCAN t" без индекса - полный проход по таблице
+        full_scan = any(p.startswith("SCAN") and " USING " not in p for p in plan)
+        report.append({"query": name, "plan": plan, "full_scan": full_scan})
+    return report
+
+# ---- лидерборд: декартово дерево (treap) с размерами поддеревьев ----
+# ключ (-balance, user_id): по убыванию баланса, при равенстве по id
+
+class _TreapNode:
+    __slots__ = ("key", "prio", "left", "right", "size")
+
+    def __init__(self, key: Tuple[int, int]):
+        self.key = key
+        self.prio = random.random()
+        self.left: Optional["_TreapNode"] = None
+        self.right: Optional["_TreapNode"] = None
+        self.size = 1
+
+def _treap_size(node: Optional[_TreapNode]) -> int:
+    return node.size if node else 0
+
+def _treap_update(node: _TreapNode) -> None:
+    node.size = 1 + _treap_size(node.left) + _treap_size(node.right)
+
+def _treap_split(node: Optional[_TreapNode], key: Tuple[int, int]) -> Tuple[Optional[_TreapNode], Optional[_TreapNode]]:
+    # (< key, >= key)
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _treap_split(node.right, key)
+        node.right = left
+        _treap_update(node)
+        return node, right
+    left, right = _treap_split(node.left, key)
+    node.left = right
+    _treap_update(node)
+    return left, node
+
+def _treap_merge(a: Optional[_TreapNode], b: Optional[_TreapNode]) -> Optional[_TreapNode]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        a.right = _treap_merge(a.right, b)
+        _treap_update(a)
+        return a
+    b.left = _treap_merge(a, b.left)
+    _treap_update(b)
+    return b
+
+class Leaderboard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root: Optional[_TreapNode] = None
+        self.balances: Dict[int, int] = {}
+        # номер последнего set_balance по пользователю: сверка не откатывает изменения, пришедшие после ее чтения
+        self.seq = 0
+        self.touched: Dict[int, int] = {}
+
+    def _insert(self, key: Tuple[int, int]) -> None:
+        left, right = _treap_split(self.root, key)
+        self.root = _treap_merge(_treap_merge(left, _TreapNode(key)), right)
+
+    def _remove(self, key: Tuple[int, int]) -> None:
+        left, rest = _treap_split(self.root, key)
+        _, right = _treap_split(rest, (key[0], key[1] + 1))
+        self.root = _treap_merge(left, right)
+
+    def set_balance(self, user_id: int, balance: int) -> None:
+        uid = int(user_id)
+        bal = int(balance)
+        with self.lock:
+            self.seq += 1
+            self.touched[uid] = self.seq
+            self._set(uid, bal)
+
+    def _set(self, uid: int, bal: Optional[int]) -> None:
+        old = self.balances.get(uid)
+        if old == bal:
+            return
+        if old is not None:
+            self._remove((-old, uid))
+            del self.balances[uid]
+        if bal is not None:
+            self._insert((-bal, uid))
+            self.balances[uid] = bal
+
+    def mark(self) -> int:
+        with self.lock:
+            return self.seq
+
+    def reconcile(self, actual: Dict[int, int], since: int) -> int:
+        # actual прочитан из БД после mark() == since; пользователей, чей баланс менялся позже, не трогаем
+        fixed = 0
+        with self.lock:
+            for uid in actual.keys() | self.balances.keys():
+                if self.touched.get(uid, 0) > since:
+                    continue
+                if actual.get(uid) != self.balances.get(uid):
+                    self._set(uid, actual.get(uid))
+                    fixed += 1
+            self.touched = {uid: n for uid, n in self.touched.items() if n > since}
+        return fixed
+
+    def rebuild(self, rows: List[Tuple[int, int]]) -> None:
+        with self.lock:
+            self.root = None
+            self.balances = {}
+            for uid, bal in rows:
+                self.balances[int(uid)] = int(bal)
+                self._insert((-int(bal), int(uid)))
+
+    def rank(self, user_id: int) -> Optional[int]:
+        uid = int(user_id)
+        with self.lock:
+            bal = self.balances.get(uid)
+            if bal is None:
+                return None
+            key = (-bal, uid)
+            rank = 0
+            node = self.root
+            while node is not None:
+                if key < node.key:
+                    node = node.left
+                elif key > node.key:
+                    rank += _treap_size(node.left) + 1
+                    node = node.right
+                else:
+                    return rank + _treap_size(node.left) + 1
+            return None
+
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        out: List[Tuple[int, int]] = []
+        with self.lock:
+            stack: List[_TreapNode] = []
+            node = self.root
+            while (stack or node is not None) and len(out) < k:
+                while node is not None:
+                    stack.append(node)
+                    node = node.left
+                node = stack.pop()
+                out.append((node.key[1], -node.key[0]))
+                node = node.right
+        return out
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.balances)
+
+class DuelRegistry:
+    # message_id анонса (прием абзацев) и сообщения голосования -> duel_id
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_announce: Dict[int, str] = {}
+        self.by_vote: Dict[int, str] = {}
+        self.loaded_at = 0.0
+
+    def load(self, duels: List[Dict[str, Any]]) -> None:
+        by_announce: Dict[int, str] = {}
+        by_vote: Dict[int, str] = {}
+        for d in duels:
+            if d["status"] == "waiting" and d.get("announce_message_id"):
+                by_announce[int(d["announce_message_id"])] = d["duel_id"]
+            elif d["status"] == "voting" and d.get("vote_message_id"):
+                by_vote[int(d["vote_message_id"])] = d["duel_id"]
+        with self.lock:
+            self.by_announce = by_announce
+            self.by_vote = by_vote
+            self.loaded_at = time.monotonic()
+
+    def add_waiting(self, duel_id: str, announce_message_id: Optional[int]) -> None:
+        if not announce_message_id:
+            return
+        with self.lock:
+            self.by_announce[int(announce_message_id)] = duel_id
+
+    def set_voting(self, duel_id: str, vote_message_id: Optional[int]) -> None:
+        with self.lock:
+            self._drop(duel_id)
+            if vote_message_id:
+                self.by_vote[int(vote_message_id)] = duel_id
+
+    def remove(self, duel_id: str) -> None:
+        with self.lock:
+            self._drop(duel_id)
+
+    def _drop(self, duel_id: str) -> None:
+        for index in (self.by_announce, self.by_vote):
+            for mid in [m for m, d in index.items() if d == duel_id]:
+                del index[mid]
+
+    def route(self, message_id: int) -> Optional[Tuple[str, str]]:
+        with self.lock:
+            duel_id = self.by_announce.get(message_id)
+            if duel_id:
+                return "waiting", duel_id
+            duel_id = self.by_vote.get(message_id)
+            if duel_id:
+                return "voting", duel_id
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"waiting": len(self.by_announce), "voting": len(self.by_vote)}
+
+IN_LIST_SIZES = (8, 32, 128, 500)
+
+def padded_in_list(ids: List[int]) -> Tuple[str, Tuple[int, ...]]:
+    # длина IN (...) округляется вверх до одного из IN_LIST_SIZES повтором последнего id:
+    # текстов запроса остается несколько, и они не вытесняют друг друга из кэша statements
+    size = next((n for n in IN_LIST_SIZES if n >= len(ids)), len(ids))
+    params = tuple(ids) + (ids[-1],) * (size - len(ids)) if ids else ()
+    return ",".join("?" * len(params)), params
+
+class PooledConn:
+    __slots__ = ("conn", "created_at", "last_used", "uses")
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+class ReadPool:
+    # не больше size соединений на процесс, сколько бы потоков ни читало; лишние ждут свободное
+    def __init__(self, path: str, size: int, timeout: float):
+        self.uri = "file:" + pathname2url(os.path.abspath(path)) + "?mode=ro"
+        self.size = max(1, int(size))
+        self.timeout = float(timeout)
+        self.cond = threading.Condition()
+        self.idle: deque = deque()
+        self.opened = 0
+        self.created = 0
+        self.recycled = 0
+        self.broken = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_ms_max = 0.0
+
+    def _connect(self) -> PooledConn:
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON;")
+        return PooledConn(conn)
+
+    def _check(self, pc: PooledConn) -> Optional[str]:
+        # None - соединение можно выдавать, иначе причина замены
+        now = time.monotonic()
+        if now - pc.created_at >= READ_CONN_MAX_AGE or pc.uses >= READ_CONN_MAX_USES:
+            return "recycled"
+        if now - pc.last_used >= READ_CONN_CHECK_IDLE:
+            try:
+                pc.conn.execute("SELECT 1").fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"read connection failed health check: {e}")
+                return "broken"
+        return None
+
+    def acquire(self) -> PooledConn:
+        started = time.monotonic()
+        with self.cond:
+            while not self.idle and self.opened >= self.size:
+                self.waits += 1
+                left = self.timeout - (time.monotonic() - started)
+                if left <= 0 or not self.cond.wait(left):
+                    if not self.idle and self.opened >= self.size:
+                        raise TimeoutError(f"no free read connection in {self.timeout:g}s (pool size {self.size})")
+            # LIFO: последнее возвращенное соединение с самым теплым кэшем страниц
+            pc = self.idle.pop() if self.idle else None
+            if pc is None:
+                self.opened += 1
+            self.acquired += 1
+            self.wait_ms_max = max(self.wait_ms_max, (time.monotonic() - started) * 1000)
+        reason = self._check(pc) if pc is not None else None
+        if reason:
+            pc.conn.close()
+            pc = None
+            with self.cond:
+                setattr(self, reason, getattr(self, reason) + 1)
+        if pc is None:
+            try:
+                pc = self._connect()
+            except Exception:
+                with self.cond:
+                    self.opened -= 1
+                    self.cond.notify()
+                raise
+            with self.cond:
+                self.created += 1
+        return pc
+
+    def release(self, pc: PooledConn, broken: bool = False) -> None:
+        pc.uses += 1
+        pc.last_used = time.monotonic()
+        with self.cond:
+            if broken:
+                self.broken += 1
+                self.opened -= 1
+            else:
+                self.idle.append(pc)
+            self.cond.notify()
+        if broken:
+            pc.conn.close()
+
+    @contextmanager
+    def connection(self):
+        pc = self.acquire()
+        broken = False
+        try:
+            yield pc.conn
+        except sqlite3.DatabaseError as e:
+            # ошибка в запросе или занятая БД соединение не портят; "disk image is malformed" и т.п. - пересоздаем
+            broken = not isinstance(e, (sqlite3.OperationalError, sqlite3.ProgrammingError, sqlite3.IntegrityError))
+            raise
+        finally:
+            self.release(pc, broken)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "size": self.size,
+                "open": self.opened,
+                "idle": len(self.idle),
+                "in_use": self.opened - len(self.idle),
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_ms_max": round(self.wait_ms_max, 1),
+                "created": self.created,
+                "recycled": self.recycled,
+                "broken": self.broken,
+                "statement_cache": SQLITE_STATEMENT_CACHE,
+            }
+
+class WriteJob:
+    def __init__(self, op, on_commit=None):
+        self.op = op
+        self.on_commit = on_commit
+        self.future: Future = Future()
+        self.queries = 0
+        self.enqueued_at = time.monotonic()
+
+class StorageWriter:
+    # единственный поток, который пишет в БД. Операции op(conn) копятся в очереди и коммитятся
+    # пачкой: одна транзакция и один fsync WAL на несколько вызовов. Каждая операция - в своем
+    # SAVEPOINT, так что ошибка одной откатывает только ее, а многошаговые операции остаются атомарными.
+    def __init__(self, store: "Storage", max_batch: int, max_wait: float):
+        self.store = store
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait))
+        self.q: "queue.Queue[WriteJob]" = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.conn: Optional[sqlite3.Connection] = None
+        self.stats_lock = threading.Lock()
+        self.ops = 0
+        self.failed_ops = 0
+        self.commits = 0
+        self.failed_commits = 0
+        self.max_batch_seen = 0
+        self.commit_ms_total = 0.0
+        self.recent_commits: deque = deque(maxlen=100000)
+
+    def start(self) -> None:
+        # соединение открываем сразу: read-only соединениям пула нужны уже существующие -wal/-shm
+        self.conn = self._connect()
+        self.thread = threading.Thread(target=self._run_forever, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def in_writer(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def submit(self, op, on_commit=None) -> WriteJob:
+        job = WriteJob(op, on_commit)
+        self.q.put(job)
+        return job
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: BEGIN/SAVEPOINT/COMMIT расставляем сами
+        conn = sqlite3.connect(self.store.path, check_same_thread=False, isolation_level=None,
+                               cached_statements=SQLITE_STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA foreign_keys=ON;")
+        return conn
+
+    def _run_forever(self) -> None:
+        conn = self.conn
+        while True:
+            batch = [self.q.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                left = deadline - time.monotonic()
+                try:
+                    batch.append(self.q.get(timeout=left) if left > 0 else self.q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit_batch(conn, batch)
+            except Exception as e:
+                logger.error(f"sqlite writer batch failed: {e}", exc_info=True)
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: List[WriteJob]) -> None:
+        started = time.perf_counter()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                self.store.reset_query_count()
+                conn.execute("SAVEPOINT op")
+                try:
+                    res, err = job.op(conn), None
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    res, err = None, e
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                job.queries = self.store.query_count()
+                results.append((job, res, err))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self.stats_lock:
+                self.failed_commits += 1
+            logger.error(f"group commit of {len(batch)} writes failed: {e}")
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        failed = 0
+        for job, res, err in results:
+            if err is None and job.on_commit is not None:
+                # обновления кэшей в памяти - в порядке коммитов, а не в порядке пробуждения вызывающих
+                try:
+                    job.on_commit(res)
+                except Exception as e:
+                    logger.error(f"on_commit hook failed: {e}", exc_info=True)
+            if err is None:
+                job.future.set_result(res)
+            else:
+                failed += 1
+                job.future.set_exception(err)
+        SQL_WRITE_BATCH.observe(len(batch))
+        with self.stats_lock:
+            self.ops += len(batch)
+            self.failed_ops += failed
+            self.commits += 1
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.commit_ms_total += elapsed_ms
+            self.recent_commits.append((time.monotonic(), len(batch)))
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self.stats_lock:
+            recent = [n for ts, n in self.recent_commits if now - ts <= 60]
+            return {
+                "queued": self.q.qsize(),
+                "ops": self.ops,
+                "failed_ops": self.failed_ops,
+                "commits": self.commits,
+                "failed_commits": self.failed_commits,
+                "avg_batch": round(self.ops / self.commits, 2) if self.commits else 0.0,
+                "max_batch": self.max_batch_seen,
+                "avg_commit_ms": round(self.commit_ms_total / self.commits, 2) if self.commits else 0.0,
+                "commits_per_sec_1m": round(len(recent) / 60.0, 2),
+                "ops_per_sec_1m": round(sum(recent) / 60.0, 2),
+            }
+
 class Storage:
     def __init__(self, path: str):
         self.path = path
         self.lock = threading.RLock()
         self.local = threading.local()
+        self.names = DisplayNameCache(USER_NAME_CACHE_SIZE, USER_NAME_CACHE_TTL)
+        self.pending_lock = threading.Lock()
+        self.pending_last_active: Dict[int, str] = {}
+        self.wb_flushes = 0
+        self.wb_rows = 0
+        self.leaderboard = Leaderboard()
+        self.duels = DuelRegistry()
         self._init_db()
+        self.writer = StorageWriter(self, WRITER_MAX_BATCH, WRITER_MAX_WAIT_MS / 1000.0)
+        self.writer.start()
+        self.readers = ReadPool(path, READ_POOL_SIZE, READ_POOL_TIMEOUT)
+        self.rebuild_leaderboard()
+        self.duels.load(self.list_active_duels())
+
+    # все запросы идут через _run/_run_many: так считаем число обращений к БД на update
+    def _run(self, conn: sqlite3.Connection, sql: str, params: Tuple = (), fetch: Optional[str] = None) -> Any:
+        # fetch="one"/"all": выборка входит в замер времени запроса
+        self.local.queries = getattr(self.local, "queries", 0) + 1
+        started = time.perf_counter()
+        try:
+            cur = conn.execute(sql, params)
+            if fetch == "one":
+                return cur.fetchone()
+            if fetch == "all":
+                return cur.fetchall()
+            return cur
+        finally:
+            elapsed = time.perf_counter() - started
+            SQL_SECONDS.observe(elapsed, sql_op(sql))
+            if sql_profiler.enabled:
+                sql_profiler.record(conn, sql, params, elapsed)
+
+    def _run_many(self, conn: sqlite3.Connection, sql: str, seq_of_params: List[Tuple]) -> sqlite3.Cursor:
+        self.local.queries = getattr(self.local, "queries", 0) + 1
+        started = time.perf_counter()
+        try:
+            return conn.executemany(sql, seq_of_params)
+        finally:
+            elapsed = time.perf_counter() - started
+            SQL_SECONDS.observe(elapsed, sql_op(sql))
+            if sql_profiler.enabled:
+                # план строим по первому набору параметров
+                sql_profiler.record(conn, sql, seq_of_params[0] if seq_of_params else (), elapsed)
+
+    def reset_query_count(self) -> None:
+        self.local.queries = 0
+
+    def query_count(self) -> int:
+        return getattr(self.local, "queries", 0)
+
+    def _write(self, op, on_commit=None) -> Any:
+        # op(conn) выполняется потоком-писателем; возврат - после COMMIT пачки.
+        # on_commit(result) вызывается писателем сразу после коммита (кэши в памяти)
+        if self.writer.in_writer():
+            res = op(self.writer.conn)
+            if on_commit is not None:
+                on_commit(res)
+            return res
+        job = self.writer.submit(op, on_commit)
+        try:
+            return job.future.result()
+        finally:
+            # запросы писателя засчитываем update, который их вызвал
+            self.local.queries = self.query_count() + job.queries
+            SQL_WRITE_WAIT.observe(time.monotonic() - job.enqueued_at)
 
-    def _get_conn(self) -> sqlite3.Connection:
-        conn = getattr(self.local, "conn", None)
-        if conn is None:
-            conn = sqlite3.connect(self.path, check_same_thread=False)
-            conn.row_factory = sqlite3.Row
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA synchronous=NORMAL;")
-            conn.execute("PRAGMA foreign_keys=ON;")
-            self.local.conn = conn
-        return conn
-
-    def _exec(self, sql: str, params: Tuple = ()) -> None:
-        with self.lock:
-            conn = self._get_conn()
-            conn.execute(sql, params)
-            conn.commit()
+    def _exec(self, sql: str, params: Tuple = ()) -> int:
+        return self._write(lambda conn: self._run(conn, sql, params).rowcount)
 
     def _exec_many(self, sql: str, seq_of_params: List[Tuple]) -> None:
-        with self.lock:
-            conn = self._get_conn()
-            conn.executemany(sql, seq_of_params)
-            conn.commit()
+        self._write(lambda conn: self._run_many(conn, sql, seq_of_params).rowcount)
+
+    def _read(self, sql: str, params: Tuple, fetch: str) -> Any:
+        # внутри операции писателя читаем его соединением: видны еще не закоммиченные изменения
+        if self.writer.in_writer():
+            return self._run(self.writer.conn, sql, params, fetch=fetch)
+        with self.readers.connection() as conn:
+            return self._run(conn, sql, params, fetch=fetch)
 
     def _query_one(self, sql: str, params: Tuple = ()) -> Optional[sqlite3.Row]:
-        conn = self._get_conn()
-        cur = conn.execute(sql, params)
-        return cur.fetchone()
+        return self._read(sql, params, "one")
 
     def _query_all(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
-        conn = self._get_conn()
-        cur = conn.execute(sql, params)
-        return cur.fetchall()
+        return self._read(sql, params, "all")
 
     def _init_db(self) -> None:
         with self.lock:
@@ -194,6 +1363,7 @@ class Storage:
             """)
 
             conn.commit()
+            apply_migrations(conn)
             conn.close()
 
     # ---- meta ----
@@ -205,6 +1375,29 @@ class Storage:
         self._exec("INSERT INTO meta(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (k, v))
 
     # ---- users ----
+    def load_user_context(self, user_id: int) -> Dict[str, Any]:
+        # users + user_state + balances + состояние очереди одним запросом на update
+        uid = int(user_id)
+        row = self._query_one(
+            """SELECT u.id, u.username, u.first_name, u.last_name, u.articles_count, u.feedback_given, u.games_played,
+                      b.balance, s.last_submit_at, s.daily_reward_date, s.state, s.blocked_at,
+                      EXISTS (SELECT 1 FROM queue q WHERE q.user_id = u.id) AS in_queue,
+                      (SELECT COUNT(*) FROM queue) AS queue_total
+               FROM users u
+               LEFT JOIN balances b ON b.user_id = u.id
+               LEFT JOIN user_state s ON s.user_id = u.id
+               WHERE u.id=?""",
+            (uid,)
+        )
+        if not row:
+            return {"id": uid, "registered": False}
+        ctx = dict(row)
+        ctx["registered"] = True
+        ctx["balance"] = int(ctx["balance"] or 0)
+        ctx["in_queue"] = bool(ctx["in_queue"])
+        ctx["queue_total"] = int(ctx["queue_total"] or 0)
+        return ctx
+
     def is_registered(self, user_id: int) -> bool:
         row = self._query_one("SELECT 1 FROM users WHERE id=?", (int(user_id),))
         return bool(row)
@@ -216,100 +1409,347 @@ class Storage:
         first_name = user_data.get("first_name", "")
         last_name = user_data.get("last_name", "")
 
-        with self.lock:
-            conn = self._get_conn()
-            existing = conn.execute("SELECT id FROM users WHERE id=?", (uid,)).fetchone()
+        self.names.invalidate(uid)
+        existing = self._query_one("SELECT username, first_name, last_name FROM users WHERE id=?", (uid,))
+        if existing and (existing["username"], existing["first_name"], existing["last_name"]) == (username, first_name, last_name):
+            # профиль не изменился: повторный /start стоит только отметки активности
+            self.set_last_active(uid)
+            return
+
+        def op(conn: sqlite3.Connection) -> bool:
+            existing = self._run(conn, "SELECT id FROM users WHERE id=?", (uid,), fetch="one")
             if not existing:
-                conn.execute(
+                self._run(
+                    conn,
                     """INSERT INTO users(id, username, first_name, last_name, registered_at, last_active, total_quotes)
                        VALUES(?,?,?,?,?,?,?)""",
                     (uid, username, first_name, last_name, now, now, 50)
                 )
-                conn.execute("INSERT INTO balances(user_id, balance) VALUES(?,?)", (uid, 50))
-                conn.execute("INSERT INTO user_state(user_id) VALUES(?)", (uid,))
-            else:
-                conn.execute(
-                    """UPDATE users SET username=?, first_name=?, last_name=?, last_active=?
-                       WHERE id=?""",
-                    (username, first_name, last_name, now, uid)
-                )
-            conn.commit()
+                self._run(conn, "INSERT INTO balances(user_id, balance) VALUES(?,?)", (uid, 50))
+                self._run(conn, "INSERT INTO user_state(user_id) VALUES(?)", (uid,))
+                self._ledger_append(conn, uid, 50, 50, "Стартовый баланс", f"signup:{uid}")
+                return True
+            self._run(
+                conn,
+                """UPDATE users SET username=?, first_name=?, last_name=?, last_active=?
+                   WHERE id=?""",
+                (username, first_name, last_name, now, uid)
+            )
+            return False
 
-    def set_last_active(self, user_id: int) -> None:
-        self._exec("UPDATE users SET last_active=? WHERE id=?", (datetime.now().isoformat(), int(user_id)))
+        def registered(created: bool) -> None:
+            if created:
+                self.leaderboard.set_balance(uid, 50)
 
-    def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        row = self._query_one("SELECT * FROM users WHERE id=?", (int(user_id),))
-        if not row:
-            return None
-        d = dict(row)
+        self._write(op, registered)
+        self.names.invalidate(uid)
+        with self.pending_lock:
+            self.pending_last_active.pop(uid, None)
+
+    # ---- write-behind ----
+    def set_last_active(self, user_id: int) -> None:
+        with self.pending_lock:
+            self.pending_last_active[int(user_id)] = datetime.now().isoformat()
+            full = len(self.pending_last_active) >= WRITE_BEHIND_MAX
+        if full:
+            self.flush_writes()
+
+    def flush_writes(self) -> int:
+        with self.pending_lock:
+            pending = self.pending_last_active
+            self.pending_last_active = {}
+        if not pending:
+            return 0
         try:
-            d["badges"] = json.loads(d.get("badges_json") or "[]")
-        except Exception:
-            d["badges"] = ["новичок"]
-        return d
+            # upsert_user мог уже записать более свежую отметку: время только двигаем вперед
+            self._exec_many(
+                "UPDATE users SET last_active=? WHERE id=? AND (last_active IS NULL OR last_active < ?)",
+                [(ts, uid, ts) for uid, ts in pending.items()]
+            )
+        except Exception as e:
+            # вернуть в буфер, не затирая более свежие отметки
+            with self.pending_lock:
+                for uid, ts in pending.items():
+                    self.pending_last_active.setdefault(uid, ts)
+            logger.error(f"write-behind flush failed ({len(pending)} rows): {e}")
+            return 0
+        with self.pending_lock:
+            self.wb_flushes += 1
+            self.wb_rows += len(pending)
+        return len(pending)
+
+    def write_behind_loop(self) -> None:
+        while True:
+            time.sleep(WRITE_BEHIND_INTERVAL)
+            try:
+                self.flush_writes()
+            except Exception as e:
+                logger.error(f"write_behind_loop error: {e}", exc_info=True)
+
+    def write_behind_stats(self) -> Dict[str, Any]:
+        with self.pending_lock:
+            return {"pending": len(self.pending_last_active), "flushes": self.wb_flushes, "rows_flushed": self.wb_rows}
+
+    def get_display_names(self, user_ids: List[int]) -> Dict[int, str]:
+        ids = list(dict.fromkeys(int(x) for x in user_ids))
+        names, missing = self.names.get_many(ids)
+        # SQLite ограничивает число параметров в запросе, поэтому IN (...) порциями
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            marks, params = padded_in_list(chunk)
+            rows = self._query_all(f"SELECT id, username, first_name, last_name FROM users WHERE id IN ({marks})", params)
+            by_id = {int(r["id"]): dict(r) for r in rows}
+            for uid in chunk:
+                name = format_display_name(uid, by_id.get(uid))
+                self.names.put(uid, name)
+                names[uid] = name
+        return names
 
     def get_balance(self, user_id: int) -> int:
         row = self._query_one("SELECT balance FROM balances WHERE user_id=?", (int(user_id),))
         return int(row["balance"]) if row else 0
 
-    def add_quotes(self, user_id: int, amount: int, reason: str) -> int:
+    # ---- кавычки: баланс меняется одним охраняемым UPDATE, каждое движение - строка в quotes_ledger ----
+    def _ledger_append(self, conn: sqlite3.Connection, uid: int, delta: int, balance_after: int,
+                       reason: str, ref: Optional[str]) -> None:
+        self._run(
+            conn,
+            "INSERT INTO quotes_ledger(user_id, delta, balance_after, reason, ref, created_at) VALUES(?,?,?,?,?,?)",
+            (uid, delta, balance_after, reason, ref, datetime.now().isoformat())
+        )
+
+    def _move_quotes(self, conn: sqlite3.Connection, uid: int, delta: int, reason: str,
+                     ref: Optional[str]) -> Optional[int]:
+        # новый баланс или None: нет пользователя, не хватает кавычек или ref уже проведен
+        if ref and self._run(conn, "SELECT 1 FROM quotes_ledger WHERE ref=?", (ref,), fetch="one"):
+            return None
+        if SQLITE_HAS_RETURNING:
+            row = self._run(
+                conn,
+                "UPDATE balances SET balance = balance + ? WHERE user_id=? AND balance + ? >= 0 RETURNING balance",
+                (delta, uid, delta),
+                fetch="one"
+            )
+        else:
+            cur = self._run(conn, "UPDATE balances SET balance = balance + ? WHERE user_id=? AND balance + ? >= 0",
+                            (delta, uid, delta))
+            row = self._run(conn, "SELECT balance FROM balances WHERE user_id=?", (uid,), fetch="one") if cur.rowcount else None
+        if row is None:
+            return None
+        bal = int(row["balance"])
+        if delta > 0:
+            self._run(conn, "UPDATE users SET total_quotes = total_quotes + ? WHERE id=?", (delta, uid))
+        self._ledger_append(conn, uid, delta, bal, reason, ref)
+        return bal
+
+    def _on_balance(self, uid: int):
+        def update(bal: Optional[int]) -> None:
+            if bal is not None:
+                self.leaderboard.set_balance(uid, bal)
+        return update
+
+    def add_quotes(self, user_id: int, amount: int, reason: str, ref: Optional[str] = None) -> Optional[int]:
+        # None - начисление не прошло (нет баланса или ref уже был)
         uid = int(user_id)
         amt = int(amount)
-        with self.lock:
-            conn = self._get_conn()
-            conn.execute("UPDATE balances SET balance = balance + ? WHERE user_id=?", (amt, uid))
-            conn.execute("UPDATE users SET total_quotes = total_quotes + ? WHERE id=?", (amt, uid))
-            conn.commit()
-        logger.info(f"quotes +{amt} to {uid} ({reason})")
-        return self.get_balance(uid)
+        bal = self._write(lambda conn: self._move_quotes(conn, uid, amt, reason, ref), self._on_balance(uid))
+        if bal is not None:
+            logger.info(f"quotes +{amt} to {uid} ({reason})")
+        return bal
 
-    def spend_quotes(self, user_id: int, amount: int, reason: str) -> bool:
+    def spend_quotes(self, user_id: int, amount: int, reason: str, ref: Optional[str] = None) -> bool:
         uid = int(user_id)
         amt = int(amount)
-        with self.lock:
-            conn = self._get_conn()
-            row = conn.execute("SELECT balance FROM balances WHERE user_id=?", (uid,)).fetchone()
-            bal = int(row["balance"]) if row else 0
-            if bal < amt:
-                return False
-            conn.execute("UPDATE balances SET balance = balance - ? WHERE user_id=?", (amt, uid))
-            conn.commit()
+        bal = self._write(lambda conn: self._move_quotes(conn, uid, -amt, reason, ref), self._on_balance(uid))
+        if bal is None:
+            return False
         logger.info(f"quotes -{amt} from {uid} ({reason})")
         return True
 
-    # ---- user_state ----
-    def get_last_submit_at(self, user_id: int) -> Optional[datetime]:
-        row = self._query_one("SELECT last_submit_at FROM user_state WHERE user_id=?", (int(user_id),))
-        if row and row["last_submit_at"]:
-            try:
-                return datetime.fromisoformat(row["last_submit_at"])
-            except Exception:
+    def claim_daily_reward(self, user_id: int, date_iso: str, amount: int) -> Optional[int]:
+        # дата отмечается условным UPDATE: из двух одновременных/повторных /daily проходит только один
+        uid = int(user_id)
+
+        def op(conn: sqlite3.Connection) -> Optional[int]:
+            cur = self._run(
+                conn,
+                """UPDATE user_state SET daily_reward_date=?
+                   WHERE user_id=? AND (daily_reward_date IS NULL OR daily_reward_date <> ?)""",
+                (date_iso, uid, date_iso)
+            )
+            if cur.rowcount != 1:
                 return None
-        return None
+            # у старых пользователей строки balances может не быть: без нее начисление не пройдет
+            self._run(conn, "INSERT OR IGNORE INTO balances(user_id, balance) VALUES(?, 0)", (uid,))
+            bal = self._move_quotes(conn, uid, int(amount), "Ежедневная награда", f"daily:{uid}:{date_iso}")
+            if bal is None:
+                # исключение откатывает savepoint операции вместе с отметкой даты: награда не сгорает
+                raise LookupError(f"daily reward for {uid} on {date_iso} not credited")
+            return bal
 
-    def set_last_submit_at(self, user_id: int, dt: datetime) -> None:
-        self._exec("UPDATE user_state SET last_submit_at=? WHERE user_id=?", (dt.isoformat(), int(user_id)))
+        try:
+            return self._write(op, self._on_balance(uid))
+        except LookupError as e:
+            logger.warning(str(e))
+            return None
 
-    def get_daily_reward_date(self, user_id: int) -> Optional[str]:
-        row = self._query_one("SELECT daily_reward_date FROM user_state WHERE user_id=?", (int(user_id),))
-        return row["daily_reward_date"] if row else None
+    def list_quotes_ledger(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+        rows = self._query_all(
+            """SELECT id, delta, balance_after, reason, ref, created_at FROM quotes_ledger
+               WHERE user_id=? ORDER BY id DESC LIMIT ?""",
+            (int(user_id), int(limit))
+        )
+        return [dict(r) for r in rows]
 
-    def set_daily_reward_date(self, user_id: int, date_iso: str) -> None:
-        self._exec("UPDATE user_state SET daily_reward_date=? WHERE user_id=?", (date_iso, int(user_id)))
+    def audit_quotes_ledger(self, user_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        # пользователи, у которых баланс не сходится с суммой движений по журналу
+        rows = self._query_all(
+            """SELECT b.user_id, b.balance, COALESCE(SUM(l.delta), 0) AS ledger_sum
+               FROM balances b LEFT JOIN quotes_ledger l ON l.user_id = b.user_id
+               WHERE ? IS NULL OR b.user_id = ?
+               GROUP BY b.user_id HAVING b.balance <> COALESCE(SUM(l.delta), 0)""",
+            (user_id, user_id)
+        )
+        return [dict(r) for r in rows]
 
-    def get_submit_notified_at(self, user_id: int) -> Optional[datetime]:
-        row = self._query_one("SELECT submit_notified_at FROM user_state WHERE user_id=?", (int(user_id),))
-        if row and row["submit_notified_at"]:
-            try:
-                return datetime.fromisoformat(row["submit_notified_at"])
-            except Exception:
+    # ---- рассылки ----
+    def create_broadcast(self, kind: str, text: str, audience: str, params: Optional[Dict[str, Any]] = None,
+                         created_by: Optional[int] = None, parse_mode: Optional[str] = None,
+                         draft: bool = False) -> Optional[Dict[str, Any]]:
+        # список получателей фиксируется в момент создания; None - получателей нет.
+        # draft - черновик: не отправляется, пока его не подтвердят confirm_broadcast
+        select_sql, claim_sql, _ = BROADCAST_AUDIENCES[audience]
+        bid = uuid.uuid4().hex[:12]
+        now = datetime.now().isoformat()
+        named = dict(params or {}, bid=bid)
+
+        def op(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            total = self._run(
+                conn,
+                f"INSERT INTO broadcast_recipients(broadcast_id, user_id) SELECT :bid, user_id FROM ({select_sql})",
+                named
+            ).rowcount
+            if total <= 0:
                 return None
-        return None
+            if claim_sql:
+                self._run(conn, claim_sql, named)
+            self._run(
+                conn,
+                """INSERT INTO broadcasts(id, kind, audience, text, parse_mode, status, created_by, created_at, total)
+                   VALUES(?,?,?,?,?,?,?,?,?)""",
+                (bid, kind, audience, text, parse_mode, "draft" if draft else "pending", created_by, now, total)
+            )
+            return {"id": bid, "kind": kind, "audience": audience, "total": total, "draft": draft}
+
+        return self._write(op)
+
+    def next_broadcast(self) -> Optional[Dict[str, Any]]:
+        # running - рассылка, прерванная рестартом или сменой лидера
+        row = self._query_one(
+            "SELECT * FROM broadcasts WHERE status IN ('pending','running') ORDER BY created_at LIMIT 1"
+        )
+        return dict(row) if row else None
+
+    def get_broadcast(self, broadcast_id: str) -> Optional[Dict[str, Any]]:
+        row = self._query_one("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,))
+        return dict(row) if row else None
+
+    def list_broadcasts(self, limit: int) -> List[Dict[str, Any]]:
+        rows = self._query_all("SELECT * FROM broadcasts ORDER BY created_at DESC LIMIT ?", (int(limit),))
+        return [dict(r) for r in rows]
+
+    def list_broadcast_pending(self, broadcast_id: str, after_user_id: int, limit: int) -> List[int]:
+        rows = self._query_all(QUERY_BROADCAST_PENDING, (broadcast_id, int(after_user_id), int(limit)))
+        return [int(r["user_id"]) for r in rows]
+
+    def start_broadcast(self, broadcast_id: str) -> None:
+        self._exec(
+            "UPDATE broadcasts SET status='running', started_at=COALESCE(started_at, ?) WHERE id=? AND status IN ('pending','running')",
+            (datetime.now().isoformat(), broadcast_id)
+        )
+
+    def finish_broadcast(self, broadcast_id: str) -> None:
+        self._exec(
+            "UPDATE broadcasts SET status='done', finished_at=? WHERE id=? AND status='running'",
+            (datetime.now().isoformat(), broadcast_id)
+        )
+
+    def confirm_broadcast(self, broadcast_id: str) -> bool:
+        return self._exec("UPDATE broadcasts SET status='pending' WHERE id=? AND status='draft'", (broadcast_id,)) > 0
+
+    def cancel_broadcast(self, broadcast_id: str) -> bool:
+        return self._exec(
+            "UPDATE broadcasts SET status='cancelled', finished_at=? WHERE id=? AND status IN ('draft','pending','running')",
+            (datetime.now().isoformat(), broadcast_id)
+        ) > 0
+
+    def move_broadcast_recipients(self, broadcast_id: str, user_ids: List[int], from_status: str, to_status: str) -> None:
+        # pending -> sending перед отправкой: после смены лидера или рестарта эти получатели не отправляются повторно
+        if not user_ids:
+            return
+        now = datetime.now().isoformat()
+        self._exec_many(
+            "UPDATE broadcast_recipients SET status=?, updated_at=? WHERE broadcast_id=? AND user_id=? AND status=?",
+            [(to_status, now, broadcast_id, int(uid), from_status) for uid in user_ids]
+        )
+
+    def prune_broadcasts(self, before: datetime) -> Tuple[int, int]:
+        # по одной рассылке на операцию писателя: удаление тысяч получателей не держит других писателей
+        rows = self._query_all(
+            """SELECT id FROM broadcasts
+               WHERE (status IN ('done','cancelled') AND COALESCE(finished_at, created_at) < ?)
+                  OR (status='draft' AND created_at < ?)""",
+            (before.isoformat(), before.isoformat())
+        )
+        removed = 0
+
+        def op(bid: str):
+            def run(conn: sqlite3.Connection) -> int:
+                n = self._run(conn, "DELETE FROM broadcast_recipients WHERE broadcast_id=?", (bid,)).rowcount
+                self._run(conn, "DELETE FROM broadcasts WHERE id=?", (bid,))
+                return n
+            return run
+
+        for r in rows:
+            removed += self._write(op(r["id"]))
+        return len(rows), removed
+
+    def record_broadcast_results(self, broadcast: Dict[str, Any], results: List[Tuple[int, str]]) -> None:
+        # results: (user_id, sent|failed|blocked); прогресс, счетчики и пометки пользователей - одной операцией
+        if not results:
+            return
+        bid = broadcast["id"]
+        now = datetime.now().isoformat()
+        on_sent_sql = BROADCAST_AUDIENCES[broadcast["audience"]][2]
+
+        def op(conn: sqlite3.Connection) -> None:
+            self._run_many(
+                conn,
+                """UPDATE broadcast_recipients SET status=?, updated_at=?
+                   WHERE broadcast_id=? AND user_id=? AND status IN ('pending','sending')""",
+                [(status, now, bid, int(uid)) for uid, status in results]
+            )
+            counts = {"sent": 0, "failed": 0, "blocked": 0}
+            for _, status in results:
+                counts[status] += 1
+            self._run(
+                conn,
+                "UPDATE broadcasts SET delivered=delivered+?, failed=failed+?, blocked=blocked+? WHERE id=?",
+                (counts["sent"], counts["failed"], counts["blocked"], bid)
+            )
+            blocked = [(now, int(uid)) for uid, status in results if status == "blocked"]
+            if blocked:
+                self._run_many(conn, "UPDATE user_state SET blocked_at=? WHERE user_id=?", blocked)
+            sent = [{"at": now, "uid": int(uid)} for uid, status in results if status == "sent"]
+            if on_sent_sql and sent:
+                self._run_many(conn, on_sent_sql, sent)
+
+        self._write(op)
 
-    def set_submit_notified_at(self, user_id: int, dt: datetime) -> None:
-        self._exec("UPDATE user_state SET submit_notified_at=? WHERE user_id=?", (dt.isoformat(), int(user_id)))
+    def unblock_user(self, user_id: int) -> None:
+        self._exec("UPDATE user_state SET blocked_at=NULL WHERE user_id=?", (int(user_id),))
 
+    # ---- user_state ----
     def set_state(self, user_id: int, state: str) -> None:
         now = datetime.now().isoformat()
         self._exec(
@@ -330,26 +1770,33 @@ class Storage:
         return int(row["c"]) if row else 0
 
     def queue_has_user(self, user_id: int) -> bool:
-        row = self._query_one("SELECT 1 FROM queue WHERE user_id=? LIMIT 1", (int(user_id),))
+        row = self._query_one(QUERY_QUEUE_HAS_USER, (int(user_id),))
         return bool(row)
 
     def add_submission_and_queue(self, user_id: int, url: str) -> str:
         uid = int(user_id)
         article_id = f"art_{int(time.time())}_{uid}"
         now = datetime.now().isoformat()
-        with self.lock:
-            conn = self._get_conn()
-            conn.execute(
+
+        def op(conn: sqlite3.Connection) -> None:
+            self._run(
+                conn,
                 "INSERT INTO submissions(article_id,user_id,url,submitted_at,status) VALUES(?,?,?,?,?)",
                 (article_id, uid, url, now, "pending")
             )
-            conn.execute(
+            self._run(
+                conn,
                 "INSERT INTO queue(article_id,user_id,queued_at) VALUES(?,?,?)",
                 (article_id, uid, now)
             )
-            conn.execute("UPDATE user_state SET last_submit_at=? WHERE user_id=?", (now, uid))
-            conn.execute("UPDATE users SET articles_count = articles_count + 1 WHERE id=?", (uid,))
-            conn.commit()
+            self._run(
+                conn,
+                "UPDATE user_state SET last_submit_at=?, next_reminder_at=? WHERE user_id=?",
+                (now, compute_next_reminder_at(now, None), uid)
+            )
+            self._run(conn, "UPDATE users SET articles_count = articles_count + 1 WHERE id=?", (uid,))
+
+        self._write(op)
         return article_id
 
     def list_queue(self, limit: int = 10) -> List[Dict[str, Any]]:
@@ -363,76 +1810,111 @@ class Storage:
         )
         return [dict(r) for r in rows]
 
-    def pop_from_queue(self, n: int) -> List[Dict[str, Any]]:
-        with self.lock:
-            conn = self._get_conn()
-            rows = conn.execute(
-                """SELECT q.position, s.article_id, s.user_id, s.url, s.submitted_at
+    def publish_batch(self, n: int, list_date: str, reward: int = 15) -> List[Dict[str, Any]]:
+        # голова очереди -> published одной транзакцией: снятие с очереди, статус, запись в published
+        # и награда либо проходят вместе, либо не проходят; сообщение в группу отправляет вызывающий после COMMIT
+        now = datetime.now().isoformat()
+
+        def op(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            rows = self._run(
+                conn,
+                """SELECT q.position, s.article_id, s.user_id, s.url, s.submitted_at,
+                          u.username, u.first_name, u.last_name
                    FROM queue q
                    JOIN submissions s ON s.article_id = q.article_id
+                   LEFT JOIN users u ON u.id = s.user_id
                    ORDER BY q.position ASC
                    LIMIT ?""",
-                (int(n),)
-            ).fetchall()
-
+                (int(n),),
+                fetch="all"
+            )
             if not rows:
                 return []
 
-            positions = [int(r["position"]) for r in rows]
-            conn.executemany("DELETE FROM queue WHERE position=?", [(p,) for p in positions])
-            conn.commit()
-
-        return [dict(r) for r in rows]
-
-    def add_published(self, article: Dict[str, Any], list_date: str) -> None:
-        with self.lock:
-            conn = self._get_conn()
-            conn.execute(
+            marks, params = padded_in_list([int(r["position"]) for r in rows])
+            self._run(conn, f"DELETE FROM queue WHERE position IN ({marks})", params)
+            self._run_many(
+                conn,
                 "INSERT INTO published(article_id,user_id,url,published_at,list_date) VALUES(?,?,?,?,?)",
-                (article["article_id"], int(article["user_id"]), article["url"], datetime.now().isoformat(), list_date)
+                [(r["article_id"], int(r["user_id"]), r["url"], now, list_date) for r in rows]
             )
-            conn.execute("UPDATE submissions SET status='published' WHERE article_id=?", (article["article_id"],))
-            conn.commit()
+            self._run_many(
+                conn,
+                "UPDATE submissions SET status='published' WHERE article_id=?",
+                [(r["article_id"],) for r in rows]
+            )
+            items = []
+            for r in rows:
+                uid = int(r["user_id"])
+                bal = self._move_quotes(conn, uid, int(reward), "Ссылка попала в лист чтения", f"published:{r['article_id']}")
+                items.append({
+                    "article_id": r["article_id"],
+                    "user_id": uid,
+                    "url": r["url"],
+                    "submitted_at": r["submitted_at"],
+                    "author": format_display_name(uid, dict(r)),
+                    "balance": bal,
+                })
+            return items
+
+        def credited(items: List[Dict[str, Any]]) -> None:
+            for it in items:
+                if it["balance"] is not None:
+                    self.leaderboard.set_balance(it["user_id"], it["balance"])
+
+        return self._write(op, credited)
 
     def list_user_submissions(self, user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-        rows = self._query_all(
-            """SELECT article_id, url, submitted_at, status
-               FROM submissions
-               WHERE user_id=?
-               ORDER BY submitted_at DESC
-               LIMIT ?""",
-            (int(user_id), int(limit))
-        )
+        rows = self._query_all(QUERY_USER_SUBMISSIONS, (int(user_id), int(limit)))
         return [dict(r) for r in rows]
 
     # ---- top ----
+    def rebuild_leaderboard(self) -> None:
+        rows = self._query_all("SELECT b.user_id, b.balance FROM balances b JOIN users u ON u.id = b.user_id")
+        self.leaderboard.rebuild([(int(r["user_id"]), int(r["balance"])) for r in rows])
+
+    def verify_leaderboard(self) -> int:
+        since = self.leaderboard.mark()
+        rows = self._query_all("SELECT b.user_id, b.balance FROM balances b JOIN users u ON u.id = b.user_id")
+        fixed = self.leaderboard.reconcile({int(r["user_id"]): int(r["balance"]) for r in rows}, since)
+        if fixed:
+            logger.warning(f"leaderboard out of sync with balances: {fixed} users fixed")
+        return fixed
+
+    def leaderboard_verify_loop(self) -> None:
+        # лидерборд свой у каждого процесса, а балансы меняют и другие воркеры: сверка в каждом процессе,
+        # но в своем потоке, а не внутри /top
+        while True:
+            time.sleep(LEADERBOARD_VERIFY_INTERVAL)
+            try:
+                self.verify_leaderboard()
+            except Exception as e:
+                logger.error(f"leaderboard verify error: {e}", exc_info=True)
+
     def top_users(self, limit: int = 10) -> List[Dict[str, Any]]:
+        top = self.leaderboard.top(int(limit))
+        if not top:
+            return []
+        marks, params = padded_in_list([uid for uid, _ in top])
         rows = self._query_all(
-            """SELECT u.id, u.username, u.first_name, u.last_name, u.articles_count, b.balance
-               FROM users u
-               JOIN balances b ON b.user_id = u.id
-               ORDER BY b.balance DESC
-               LIMIT ?""",
-            (int(limit),)
+            f"""SELECT id, username, first_name, last_name, articles_count
+                FROM users WHERE id IN ({marks})""",
+            params
         )
-        return [dict(r) for r in rows]
+        by_id = {int(r["id"]): dict(r) for r in rows}
+        out = []
+        for uid, bal in top:
+            row = by_id.get(uid)
+            if row:
+                row["balance"] = bal
+                out.append(row)
+        return out
 
     def rank_of_user(self, user_id: int) -> Tuple[int, int]:
-        uid = int(user_id)
-        row_total = self._query_one("SELECT COUNT(*) AS c FROM users")
-        total = int(row_total["c"]) if row_total else 0
-        rows = self._query_all(
-            """SELECT u.id
-               FROM users u
-               JOIN balances b ON b.user_id = u.id
-               ORDER BY b.balance DESC"""
-        )
-        rank = total
-        for i, r in enumerate(rows, 1):
-            if int(r["id"]) == uid:
-                rank = i
-                break
-        return rank, total
+        board = self.leaderboard
+        total = len(board)
+        rank = board.rank(user_id)
+        return (rank if rank is not None else total), total
 
     # ---- games ----
     def add_game_history(self, game_type: str, payload: Dict[str, Any]) -> None:
@@ -454,76 +1936,468 @@ class Storage:
                 submissions_deadline.isoformat()
             )
         )
-
-    def get_active_duel_waiting(self) -> Optional[Dict[str, Any]]:
-        row = self._query_one("SELECT * FROM duels WHERE status='waiting' ORDER BY created_at DESC LIMIT 1")
-        return dict(row) if row else None
-
-    def get_active_duel_voting(self) -> Optional[Dict[str, Any]]:
-        row = self._query_one("SELECT * FROM duels WHERE status='voting' ORDER BY created_at DESC LIMIT 1")
-        return dict(row) if row else None
+        self.duels.add_waiting(duel_id, announce_message_id)
 
     def get_duel_by_id(self, duel_id: str) -> Optional[Dict[str, Any]]:
         row = self._query_one("SELECT * FROM duels WHERE duel_id=?", (duel_id,))
         return dict(row) if row else None
 
-    def update_duel_json_fields(self, duel_id: str, participants: List[int], paragraphs: Dict[str, str], votes: Dict[str, int]) -> None:
-        self._exec(
-            """UPDATE duels SET participants_json=?, paragraphs_json=?, votes_json=? WHERE duel_id=?""",
-            (
-                json.dumps(participants, ensure_ascii=False),
-                json.dumps(paragraphs, ensure_ascii=False),
-                json.dumps(votes, ensure_ascii=False),
-                duel_id
-            )
+    def add_duel_entry(self, duel_id: str, user_id: int, text: str) -> bool:
+        # номер абзаца выдается тем же оператором, поэтому два одновременных ответа не получат один номер;
+        # статус проверяется в том же операторе: реестр этого воркера мог устареть после смены статуса лидером
+        added = self._exec(
+            # номер - скалярным подзапросом: у агрегата без GROUP BY строка есть всегда, и проверка статуса
+            # в его WHERE не останавливала бы INSERT
+            """INSERT OR IGNORE INTO duel_entries(duel_id,user_id,position,text,created_at)
+               SELECT ?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM duel_entries WHERE duel_id=?), ?, ?
+               WHERE EXISTS (SELECT 1 FROM duels WHERE duel_id=? AND status='waiting')""",
+            (duel_id, int(user_id), duel_id, text, datetime.now().isoformat(), duel_id)
+        ) == 1
+        if not added:
+            self._forget_stale_duel(duel_id, "waiting")
+        return added
+
+    def add_duel_vote(self, duel_id: str, voter_id: int, choice: int) -> bool:
+        added = self._exec(
+            """INSERT OR IGNORE INTO duel_votes(duel_id,voter_id,choice,created_at)
+               SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM duel_entries WHERE duel_id=? AND position=?)
+                 AND EXISTS (SELECT 1 FROM duels WHERE duel_id=? AND status='voting')""",
+            (duel_id, int(voter_id), int(choice), datetime.now().isoformat(), duel_id, int(choice), duel_id)
+        ) == 1
+        if not added:
+            self._forget_stale_duel(duel_id, "voting")
+        return added
+
+    def _forget_stale_duel(self, duel_id: str, expected: str) -> None:
+        # статус в БД уже другой - убираем дуэль из реестра, следующий промах перечитает активные дуэли
+        row = self._query_one("SELECT status FROM duels WHERE duel_id=?", (duel_id,))
+        if not row or row["status"] != expected:
+            self.duels.remove(duel_id)
+
+    def list_duel_entries(self, duel_id: str) -> List[Dict[str, Any]]:
+        rows = self._query_all(
+            "SELECT user_id, position, text FROM duel_entries WHERE duel_id=? ORDER BY position ASC",
+            (duel_id,)
         )
+        return [dict(r) for r in rows]
+
+    def list_duel_votes(self, duel_id: str) -> Dict[str, int]:
+        rows = self._query_all("SELECT voter_id, choice FROM duel_votes WHERE duel_id=?", (duel_id,))
+        return {str(r["voter_id"]): int(r["choice"]) for r in rows}
+
+    def duel_tally(self, duel_id: str) -> List[Dict[str, Any]]:
+        rows = self._query_all(
+            """SELECT v.choice, e.user_id, COUNT(*) AS votes
+               FROM duel_votes v
+               JOIN duel_entries e ON e.duel_id = v.duel_id AND e.position = v.choice
+               WHERE v.duel_id=?
+               GROUP BY v.choice, e.user_id
+               ORDER BY votes DESC, v.choice ASC""",
+            (duel_id,)
+        )
+        return [dict(r) for r in rows]
 
     def set_duel_status(self, duel_id: str, status: str) -> None:
         self._exec("UPDATE duels SET status=? WHERE duel_id=?", (status, duel_id))
+        if status not in ("waiting", "voting"):
+            self.duels.remove(duel_id)
 
     def set_duel_voting(self, duel_id: str, vote_message_id: int, vote_deadline: datetime) -> None:
         self._exec(
             "UPDATE duels SET status='voting', vote_message_id=?, vote_deadline=? WHERE duel_id=?",
             (int(vote_message_id), vote_deadline.isoformat(), duel_id)
         )
+        self.duels.set_voting(duel_id, vote_message_id)
+
+    def route_duel_reply(self, message_id: int) -> Optional[Tuple[str, str]]:
+        # ("waiting"|"voting", duel_id) или None для ответов, не относящихся к дуэлям
+        route = self.duels.route(int(message_id))
+        if route is None and time.monotonic() - self.duels.loaded_at >= DUEL_REGISTRY_REFRESH:
+            # дуэль мог создать другой воркер
+            self.duels.load(self.list_active_duels())
+            route = self.duels.route(int(message_id))
+        return route
 
     def set_duel_winner(self, duel_id: str, winner_id: Optional[int]) -> None:
         self._exec("UPDATE duels SET winner=? WHERE duel_id=?", (int(winner_id) if winner_id else None, duel_id))
 
     def list_duels_due(self, now: datetime) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-        waiting = self._query_all(
-            "SELECT * FROM duels WHERE status='waiting' AND submissions_deadline IS NOT NULL AND submissions_deadline <= ?",
-            (now.isoformat(),)
-        )
-        voting = self._query_all(
-            "SELECT * FROM duels WHERE status='voting' AND vote_deadline IS NOT NULL AND vote_deadline <= ?",
-            (now.isoformat(),)
-        )
+        waiting = self._query_all(QUERY_DUELS_DUE_WAITING, (now.isoformat(),))
+        voting = self._query_all(QUERY_DUELS_DUE_VOTING, (now.isoformat(),))
         return ([dict(r) for r in waiting], [dict(r) for r in voting])
 
+    # ---- jobs ----
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        rows = self._query_all("SELECT * FROM jobs")
+        out = []
+        for r in rows:
+            d = dict(r)
+            try:
+                d["payload"] = json.loads(d.get("payload_json") or "{}")
+            except Exception:
+                d["payload"] = {}
+            out.append(d)
+        return out
+
+    def upsert_job(self, name: str, handler: str, kind: str, spec: Optional[str], payload: Dict[str, Any],
+                   next_run: float, last_run: Optional[float] = None) -> None:
+        self._exec(
+            """INSERT INTO jobs(name,handler,kind,spec,payload_json,next_run,last_run) VALUES(?,?,?,?,?,?,?)
+               ON CONFLICT(name) DO UPDATE SET handler=excluded.handler, kind=excluded.kind, spec=excluded.spec,
+                   payload_json=excluded.payload_json, next_run=excluded.next_run,
+                   last_run=COALESCE(excluded.last_run, jobs.last_run)""",
+            (name, handler, kind, spec, json.dumps(payload, ensure_ascii=False), float(next_run), last_run)
+        )
+
+    def delete_job(self, name: str) -> None:
+        self._exec("DELETE FROM jobs WHERE name=?", (name,))
+
+    # ---- processed updates ----
+    def claim_update(self, update_id: int) -> bool:
+        # True - update видим впервые
+        return self._exec(
+            "INSERT OR IGNORE INTO processed_updates(update_id, seen_at) VALUES(?,?)",
+            (int(update_id), time.time())
+        ) == 1
+
+    def prune_processed_updates(self, older_than: float) -> int:
+        return self._exec("DELETE FROM processed_updates WHERE seen_at < ?", (float(older_than),))
+
+    # ---- leases ----
+    def try_acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        # один оператор: захват свободной/просроченной аренды или продление своей
+        now = time.time()
+        return self._exec(
+            """INSERT INTO leases(name,holder,acquired_at,heartbeat_at,expires_at) VALUES(?,?,?,?,?)
+               ON CONFLICT(name) DO UPDATE SET
+                   acquired_at=CASE WHEN leases.holder=excluded.holder THEN leases.acquired_at ELSE excluded.acquired_at END,
+                   holder=excluded.holder,
+                   heartbeat_at=excluded.heartbeat_at,
+                   expires_at=excluded.expires_at
+               WHERE leases.holder=excluded.holder OR leases.expires_at < ?""",
+            (name, holder, now, now, now + float(ttl), now)
+        ) == 1
+
+    def release_lease(self, name: str, holder: str) -> None:
+        self._exec("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+    def get_lease(self, name: str) -> Optional[Dict[str, Any]]:
+        row = self._query_one("SELECT * FROM leases WHERE name=?", (name,))
+        return dict(row) if row else None
+
+    def list_active_duels(self) -> List[Dict[str, Any]]:
+        rows = self._query_all(QUERY_ACTIVE_DUELS)
+        return [dict(r) for r in rows]
+
 store = Storage(DB_PATH)
+threading.Thread(target=store.write_behind_loop, name="write-behind", daemon=True).start()
+threading.Thread(target=store.leaderboard_verify_loop, name="leaderboard-verify", daemon=True).start()
+atexit.register(store.flush_writes)
 
 # =========================
 # TELEGRAM API
 # =========================
 
+class TelegramClient:
+    def __init__(self, token: str, pool_size: int, api_base: str = "https://api.telegram.org"):
+        self.base_url = f"{api_base}/bot{token}"
+        self.session = requests.Session()
+        # pool_block: не открываем больше pool_size соединений, лишние потоки ждут свободное
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, int(pool_size)), pool_block=True)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.pool_size = max(1, int(pool_size))
+        self.stats_lock = threading.Lock()
+        self.methods: Dict[str, Dict[str, Any]] = {}
+
+    def call(self, method: str, payload: dict, timeout: int = 12) -> Optional[dict]:
+        url = f"{self.base_url}/{method}"
+        started = time.monotonic()
+        data = None
+        try:
+            resp = self.session.post(url, json=payload, timeout=timeout)
+            data = resp.json()
+            if not data.get("ok"):
+                logger.error(f"Telegram API error {method}: {data.get('description')} | keys={list(payload.keys())}")
+            return data
+        except Exception as e:
+            logger.error(f"Telegram request failed {method}: {e}")
+            return None
+        finally:
+            self._record(method, (time.monotonic() - started) * 1000, bool(data and data.get("ok")))
+
+    def _record(self, method: str, elapsed_ms: float, ok: bool) -> None:
+        with self.stats_lock:
+            st = self.methods.get(method)
+            if st is None:
+                st = self.methods[method] = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+            st["count"] += 1
+            if not ok:
+                st["errors"] += 1
+            st["total_ms"] += elapsed_ms
+            st["max_ms"] = max(st["max_ms"], elapsed_ms)
+        TG_SECONDS.observe(elapsed_ms / 1000.0, method)
+        if not ok:
+            TG_ERRORS.inc(1, method)
+
+    def connection_stats(self) -> Dict[str, int]:
+        # urllib3 считает открытые соединения и запросы по каждому пулу (хосту)
+        opened = 0
+        reqs = 0
+        try:
+            pools = self.adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += int(getattr(pool, "num_connections", 0))
+                reqs += int(getattr(pool, "num_requests", 0))
+        except Exception as e:
+            logger.warning(f"connection stats unavailable: {e}")
+        return {"opened": opened, "requests": reqs, "reused": max(0, reqs - opened), "pool_size": self.pool_size}
+
+    def stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            methods = {
+                m: {
+                    "count": st["count"],
+                    "errors": st["errors"],
+                    "avg_ms": round(st["total_ms"] / st["count"], 1) if st["count"] else 0.0,
+                    "max_ms": round(st["max_ms"], 1),
+                }
+                for m, st in self.methods.items()
+            }
+        return {"methods": methods, "connections": self.connection_stats()}
+
+tg_client = TelegramClient(TELEGRAM_TOKEN, TG_POOL_SIZE, TELEGRAM_API_BASE)
+
 def tg(method: str, payload: dict, timeout: int = 12):
     if not TELEGRAM_TOKEN:
         logger.error("TELEGRAM_TOKEN не установлен")
         return None
+    return tg_client.call(method, payload, timeout=timeout)
 
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/{method}"
-    try:
-        resp = requests.post(url, json=payload, timeout=timeout)
-        data = resp.json()
-        if not data.get("ok"):
-            logger.error(f"Telegram API error {method}: {data.get('description')} | keys={list(payload.keys())}")
-        return data
-    except Exception as e:
-        logger.error(f"Telegram request failed {method}: {e}")
+# =========================
+# ИСХОДЯЩИЕ: лимиты и приоритеты
+# =========================
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+class TokenBucket:
+    # не потокобезопасен: используется только под OutboundScheduler.cond
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(0.001, float(rate))
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+class OutboundJob:
+    def __init__(self, method: str, payload: dict, chat_id: Optional[int], priority: int):
+        self.method = method
+        self.payload = payload
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future: Future = Future()
+        self.attempts = 0
+        self.not_before = 0.0
+        self.enqueued_at = time.monotonic()
+
+class OutboundScheduler:
+    def __init__(self, sender, workers: int):
+        self.sender = sender
+        self.workers = max(1, int(workers))
+        self.cond = threading.Condition()
+        self.lanes: Dict[int, deque] = {PRIORITY_INTERACTIVE: deque(), PRIORITY_BULK: deque()}
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.inflight: set = set()
+        self.sent = 0
+        self.retried = 0
+        self.gave_up = 0
+        self.withdrawn = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True).start()
+
+    def _enqueue(self, method: str, payload: dict, chat_id: Optional[int], priority: int) -> OutboundJob:
+        job = OutboundJob(method, payload, int(chat_id) if chat_id is not None else None, priority)
+        with self.cond:
+            self.lanes.setdefault(priority, deque()).append(job)
+            self.cond.notify()
+        return job
+
+    def submit(self, method: str, payload: dict, chat_id: Optional[int] = None,
+               priority: int = PRIORITY_INTERACTIVE) -> Future:
+        return self._enqueue(method, payload, chat_id, priority).future
+
+    def _withdraw(self, job: OutboundJob) -> bool:
+        # True - задача еще ждала в очереди и снята; False - воркер уже отправляет ее
+        with self.cond:
+            lane = self.lanes.get(job.priority)
+            if lane is None or job not in lane:
+                return False
+            lane.remove(job)
+            self.withdrawn += 1
+        job.future.set_exception(TimeoutError(f"not sent within {OUTBOUND_WAIT_TIMEOUT:g}s"))
+        return True
+
+    def call(self, method: str, payload: dict, chat_id: Optional[int] = None,
+             priority: int = PRIORITY_INTERACTIVE) -> Optional[dict]:
+        job = self._enqueue(method, payload, chat_id, priority)
+        try:
+            return job.future.result(timeout=OUTBOUND_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            if self._withdraw(job):
+                # снята с очереди: вызывающий считает сообщение недоставленным, и оно действительно не уйдет
+                logger.error(f"outbound {method} to {chat_id} dropped: queued longer than {OUTBOUND_WAIT_TIMEOUT:g}s")
+                return None
+        except Exception as e:
+            logger.error(f"outbound {method} to {chat_id} not delivered: {e!r}")
+            return None
+        # запрос уже в полете: ждем ответ, его длительность ограничена таймаутом HTTP-клиента
+        try:
+            return job.future.result()
+        except Exception as e:
+            logger.error(f"outbound {method} to {chat_id} not delivered: {e!r}")
+            return None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(TG_GROUP_RATE_PER_MIN / 60.0, TG_CHAT_BURST)
+            else:
+                bucket = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_buckets(self, now: float) -> None:
+        # полные и не заблокированные ведра ничем не отличаются от новых
+        if len(self.chat_buckets) < 10000:
+            return
+        for chat_id in [c for c, b in self.chat_buckets.items() if b.idle(now) and c not in self.inflight]:
+            del self.chat_buckets[chat_id]
+
+    def _next_job(self) -> OutboundJob:
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wait: Optional[float] = None
+                global_delay = self.global_bucket.delay(now)
+                for prio in sorted(self.lanes):
+                    lane = self.lanes[prio]
+                    if not lane:
+                        continue
+                    if global_delay > 0:
+                        wait = global_delay
+                        break
+                    seen = set()
+                    for job in lane:
+                        # внутри одного чата сохраняем порядок и не шлем параллельно
+                        if job.chat_id is not None:
+                            if job.chat_id in seen or job.chat_id in self.inflight:
+                                seen.add(job.chat_id)
+                                continue
+                            seen.add(job.chat_id)
+                        delay = job.not_before - now
+                        if job.chat_id is not None:
+                            delay = max(delay, self._chat_bucket(job.chat_id).delay(now))
+                        if delay > 0:
+                            wait = delay if wait is None else min(wait, delay)
+                            continue
+                        lane.remove(job)
+                        self.global_bucket.take(now)
+                        if job.chat_id is not None:
+                            self._chat_bucket(job.chat_id).take(now)
+                            self.inflight.add(job.chat_id)
+                        waited_ms = (now - job.enqueued_at) * 1000
+                        self.wait_total_ms += waited_ms
+                        self.wait_max_ms = max(self.wait_max_ms, waited_ms)
+                        self._prune_buckets(now)
+                        return job
+                self.cond.wait(timeout=wait)
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            resp = None
+            try:
+                resp = self.sender(job.method, job.payload)
+            except Exception as e:
+                logger.error(f"outbound {job.method} failed: {e}", exc_info=True)
+
+            retry_after = telegram_retry_after(resp)
+            with self.cond:
+                if job.chat_id is not None:
+                    self.inflight.discard(job.chat_id)
+                if retry_after is not None and job.attempts < OUTBOUND_MAX_RETRIES:
+                    job.attempts += 1
+                    until = time.monotonic() + retry_after
+                    bucket = self._chat_bucket(job.chat_id) if job.chat_id is not None else self.global_bucket
+                    bucket.blocked_until = max(bucket.blocked_until, until)
+                    job.not_before = until
+                    self.lanes[job.priority].appendleft(job)
+                    self.retried += 1
+                    self.cond.notify_all()
+                    logger.warning(f"429 on {job.method} chat={job.chat_id}, retry in {retry_after}s (attempt {job.attempts})")
+                    continue
+                if retry_after is not None:
+                    self.gave_up += 1
+                self.sent += 1
+                self.cond.notify_all()
+            job.future.set_result(resp)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "queued": {("interactive" if p == PRIORITY_INTERACTIVE else "bulk" if p == PRIORITY_BULK else str(p)): len(l)
+                           for p, l in self.lanes.items()},
+                "inflight": len(self.inflight),
+                "sent": self.sent,
+                "retried_429": self.retried,
+                "gave_up_429": self.gave_up,
+                "withdrawn_timeout": self.withdrawn,
+                "avg_wait_ms": round(self.wait_total_ms / self.sent, 1) if self.sent else 0.0,
+                "max_wait_ms": round(self.wait_max_ms, 1),
+                "chat_buckets": len(self.chat_buckets),
+            }
+
+def telegram_retry_after(resp: Optional[dict]) -> Optional[float]:
+    if not resp or resp.get("ok") or int(resp.get("error_code") or 0) != 429:
         return None
+    params = resp.get("parameters") or {}
+    try:
+        return max(1.0, float(params.get("retry_after", 1)))
+    except Exception:
+        return 1.0
+
+outbound = OutboundScheduler(lambda method, payload: tg(method, payload), OUTBOUND_WORKERS)
+outbound.start()
 
-def send_telegram_message(chat_id, text, parse_mode="HTML", reply_markup=None, message_thread_id=None, reply_to_message_id=None):
+def send_telegram_message(chat_id, text, parse_mode="HTML", reply_markup=None, message_thread_id=None, reply_to_message_id=None,
+                          priority=PRIORITY_INTERACTIVE):
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -539,10 +2413,10 @@ def send_telegram_message(chat_id, text, parse_mode="HTML", reply_markup=None, m
         payload["reply_to_message_id"] = int(reply_to_message_id)
 
     logger.info(f"sendMessage -> chat_id={chat_id} thread={message_thread_id} text={str(text)[:120]}...")
-    return tg("sendMessage", payload)
+    return outbound.call("sendMessage", payload, chat_id=chat_id, priority=priority)
 
 def answer_callback(callback_query_id, text, show_alert=False):
-    return tg("answerCallbackQuery", {
+    return outbound.call("answerCallbackQuery", {
         "callback_query_id": callback_query_id,
         "text": text,
         "show_alert": show_alert
@@ -572,12 +2446,8 @@ def normalize_command(text: str) -> str:
     return cmd
 
 def safe_username(user_id: int) -> str:
-    u = store.get_user(user_id) or {}
-    username = u.get("username")
-    if username:
-        return "@" + username
-    name = (u.get("first_name", "") + " " + u.get("last_name", "")).strip()
-    return name if name else f"пользователь {user_id}"
+    uid = int(user_id)
+    return store.get_display_names([uid])[uid]
 
 def parse_domain(url: str) -> str:
     try:
@@ -615,10 +2485,17 @@ def choose_thread_id(incoming_thread_id: Optional[int], forced_topic_id: int = 0
 # ЛОГИКА КЛУБА
 # =========================
 
-def can_submit_article(user_id: int) -> Tuple[bool, str]:
+def can_submit_article(user_id: int, ctx: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
     uid = int(user_id)
+    if ctx is None:
+        ctx = store.load_user_context(uid)
 
-    last_submit = store.get_last_submit_at(uid)
+    last_submit = None
+    if ctx.get("last_submit_at"):
+        try:
+            last_submit = datetime.fromisoformat(ctx["last_submit_at"])
+        except Exception:
+            last_submit = None
     if last_submit:
         diff = datetime.now() - last_submit
         if diff.total_seconds() < 48 * 3600:
@@ -627,10 +2504,10 @@ def can_submit_article(user_id: int) -> Tuple[bool, str]:
                 return False, "Можно будет подать менее чем через час"
             return False, f"Можно будет подать через {hours_left} часов"
 
-    if store.queue_has_user(uid):
+    if ctx.get("in_queue"):
         return False, "У тебя уже есть ссылка в очереди"
 
-    if store.queue_count() >= 10:
+    if ctx.get("queue_total", 0) >= 10:
         return False, "Очередь заполнена (максимум 10 ссылок)"
 
     return True, "Можно подавать"
@@ -682,19 +2559,19 @@ def show_help(chat_id: int, thread_id: Optional[int] = None) -> None:
 """
     send_telegram_message(chat_id, text, message_thread_id=thread_id)
 
-def show_profile(user_id: int, chat_id: int, thread_id: Optional[int] = None) -> None:
-    if not store.is_registered(user_id):
+def show_profile(user_id: int, chat_id: int, thread_id: Optional[int] = None, ctx: Optional[Dict[str, Any]] = None) -> None:
+    u = ctx if ctx is not None else store.load_user_context(user_id)
+    if not u["registered"]:
         send_telegram_message(chat_id, "Сначала зарегистрируйся через /start в личке с ботом.", message_thread_id=thread_id)
         return
 
-    u = store.get_user(user_id) or {}
-    balance = store.get_balance(user_id)
+    balance = u["balance"]
     rank, total = store.rank_of_user(user_id)
 
     text = f"""👤 <b>Профиль</b>
 
 <b>Имя:</b> {html_escape(u.get("first_name",""))} {html_escape(u.get("last_name",""))}
-<b>Юзернейм:</b> @{html_escape(u.get("username","нет"))}
+<b>Юзернейм:</b> @{html_escape(u.get("username") or "нет")}
 <b>Рейтинг:</b> #{rank} из {total}
 
 <b>Статистика:</b>
@@ -748,26 +2625,32 @@ def show_queue(chat_id: int, thread_id: Optional[int] = None) -> None:
         send_telegram_message(chat_id, "📭 <b>Очередь</b>\n\nПусто.", message_thread_id=thread_id)
         return
 
+    names = store.get_display_names([int(a["user_id"]) for a in q])
     lines = ["📋 <b>Очередь публикаций</b>\n"]
     for i, a in enumerate(q, 1):
-        author = safe_username(int(a["user_id"]))
+        author = names[int(a["user_id"])]
         url = a["url"]
         lines.append(f"{i}. 👤 <b>{html_escape(author)}</b>\n   🔗 <a href=\"{url}\">Открыть</a>")
     lines.append(f"\n<b>Всего:</b> {store.queue_count()} из 10")
     send_telegram_message(chat_id, "\n".join(lines), message_thread_id=thread_id)
 
-def give_daily_reward(user_id: int) -> None:
+def give_daily_reward(user_id: int, ctx: Optional[Dict[str, Any]] = None) -> None:
     today = datetime.now().date().isoformat()
-    if store.get_daily_reward_date(user_id) == today:
+    if ctx is None:
+        ctx = store.load_user_context(user_id)
+    if ctx.get("daily_reward_date") == today:
         send_telegram_message(user_id, "⏳ Ты уже получал ежедневку сегодня.")
         return
     reward = 5
-    bal = store.add_quotes(user_id, reward, "Ежедневная награда")
-    store.set_daily_reward_date(user_id, today)
+    bal = store.claim_daily_reward(user_id, today, reward)
+    if bal is None:
+        # повторная доставка или параллельный /daily: награду уже забрал другой запрос
+        send_telegram_message(user_id, "⏳ Ты уже получал ежедневку сегодня.")
+        return
     send_telegram_message(user_id, f"🎁 +{reward} 🪙\nНовый баланс: {bal}")
 
-def start_article_submission(user_id: int) -> None:
-    ok, msg = can_submit_article(user_id)
+def start_article_submission(user_id: int, ctx: Optional[Dict[str, Any]] = None) -> None:
+    ok, msg = can_submit_article(user_id, ctx)
     if not ok:
         send_telegram_message(user_id, f"⏳ {html_escape(msg)}")
         return
@@ -857,66 +2740,29 @@ def start_duel_in_group(initiator_id: int, thread_id: Optional[int]) -> None:
         announce_message_id=msg_id,
         submissions_deadline=deadline
     )
+    scheduler.schedule_once(f"duel_submissions:{duel_id}", "duel_submissions", utc_timestamp(deadline), {"duel_id": duel_id})
 
-def duel_load_json(duel: Dict[str, Any]) -> Tuple[List[int], Dict[str, str], Dict[str, int]]:
-    try:
-        participants = json.loads(duel.get("participants_json") or "[]")
-        paragraphs = json.loads(duel.get("paragraphs_json") or "{}")
-        votes = json.loads(duel.get("votes_json") or "{}")
-        if not isinstance(participants, list):
-            participants = []
-        if not isinstance(paragraphs, dict):
-            paragraphs = {}
-        if not isinstance(votes, dict):
-            votes = {}
-        return participants, paragraphs, votes
-    except Exception:
-        return [], {}, {}
-
-def duel_accept_paragraph(user_id: int, text: str) -> None:
-    duel = store.get_active_duel_waiting()
-    if not duel:
-        return
-
-    participants, paragraphs, votes = duel_load_json(duel)
-
-    uid = int(user_id)
-    if str(uid) in paragraphs:
-        return
-
-    paragraphs[str(uid)] = text.strip()
-    participants.append(uid)
-    store.update_duel_json_fields(duel["duel_id"], participants, paragraphs, votes)
-
-def duel_accept_vote(voter_id: int, vote_index: int) -> None:
-    duel = store.get_active_duel_voting()
-    if not duel:
-        return
-
-    participants, paragraphs, votes = duel_load_json(duel)
-    vid = int(voter_id)
-
-    if str(vid) in votes:
-        return
+def duel_accept_paragraph(duel_id: str, user_id: int, text: str) -> None:
+    store.add_duel_entry(duel_id, int(user_id), text.strip())
 
-    if 1 <= vote_index <= len(participants):
-        votes[str(vid)] = int(vote_index)
-        store.update_duel_json_fields(duel["duel_id"], participants, paragraphs, votes)
+def duel_accept_vote(duel_id: str, voter_id: int, vote_index: int) -> None:
+    store.add_duel_vote(duel_id, int(voter_id), int(vote_index))
 
 def duel_finish_submissions(duel: Dict[str, Any]) -> None:
-    participants, paragraphs, votes = duel_load_json(duel)
+    entries = store.list_duel_entries(duel["duel_id"])
     thread_id = duel.get("thread_id")
 
-    if len(paragraphs) < 2:
+    if len(entries) < 2:
         store.set_duel_status(duel["duel_id"], "cancelled")
         send_telegram_message(GROUP_ID, "⚔️ Дуэль отменена: недостаточно участников.", message_thread_id=thread_id)
         return
 
-    lines = [f"🗳 <b>Голосование в дуэли</b>\n\n<b>Тема:</b> {html_escape(duel['topic'])}\n<b>Участников:</b> {len(participants)}\n"]
-    for i, uid in enumerate(participants, 1):
-        username = html_escape(safe_username(uid))
-        snippet = html_escape((paragraphs.get(str(uid), "")[:240]).strip())
-        lines.append(f"\n<b>#{i} - {username}</b>\n{snippet}\n")
+    lines = [f"🗳 <b>Голосование в дуэли</b>\n\n<b>Тема:</b> {html_escape(duel['topic'])}\n<b>Участников:</b> {len(entries)}\n"]
+    names = store.get_display_names([int(e["user_id"]) for e in entries])
+    for e in entries:
+        username = html_escape(names[int(e["user_id"])])
+        snippet = html_escape(((e["text"] or "")[:240]).strip())
+        lines.append(f"\n<b>#{e['position']} - {username}</b>\n{snippet}\n")
 
     lines.append("\nОтветь числом (1, 2, 3...) на это сообщение. Время: 10 минут.")
     resp = send_telegram_message(GROUP_ID, "\n".join(lines), message_thread_id=thread_id)
@@ -926,64 +2772,52 @@ def duel_finish_submissions(duel: Dict[str, Any]) -> None:
 
     vote_deadline = datetime.utcnow() + timedelta(minutes=10)
     store.set_duel_voting(duel["duel_id"], vote_msg_id or 0, vote_deadline)
+    scheduler.schedule_once(f"duel_voting:{duel['duel_id']}", "duel_voting", utc_timestamp(vote_deadline),
+                            {"duel_id": duel["duel_id"]})
 
 def duel_finish_voting(duel: Dict[str, Any]) -> None:
-    participants, paragraphs, votes = duel_load_json(duel)
+    tally = store.duel_tally(duel["duel_id"])
     thread_id = duel.get("thread_id")
 
-    if not votes:
+    if not tally:
         store.set_duel_status(duel["duel_id"], "finished")
         send_telegram_message(GROUP_ID, "⚔️ Дуэль завершена: никто не проголосовал.", message_thread_id=thread_id)
         return
 
-    counts = defaultdict(int)
-    for v in votes.values():
-        try:
-            counts[int(v)] += 1
-        except Exception:
-            pass
-
-    winner_index = max(counts.items(), key=lambda x: x[1])[0]
-    winner_id = None
-    if 1 <= winner_index <= len(participants):
-        winner_id = participants[winner_index - 1]
+    winner_id = int(tally[0]["user_id"])
 
     store.set_duel_winner(duel["duel_id"], winner_id)
     store.set_duel_status(duel["duel_id"], "finished")
 
-    if winner_id:
-        store.add_quotes(winner_id, int(duel["prize"]), "Победа в дуэли")
-        store.add_game_history("duel", {
-            "topic": duel["topic"],
-            "winner": winner_id,
-            "votes": votes,
-            "participants": participants
-        })
-        send_telegram_message(
-            GROUP_ID,
-            f"🏆 <b>Дуэль завершена!</b>\n\n<b>Победитель:</b> {html_escape(safe_username(winner_id))}\n<b>Тема:</b> {html_escape(duel['topic'])}\n<b>Приз:</b> {duel['prize']} 🪙",
-            message_thread_id=thread_id
-        )
+    store.add_quotes(winner_id, int(duel["prize"]), "Победа в дуэли", ref=f"duel:{duel['duel_id']}")
+    store.add_game_history("duel", {
+        "topic": duel["topic"],
+        "winner": winner_id,
+        "votes": store.list_duel_votes(duel["duel_id"]),
+        "participants": [int(e["user_id"]) for e in store.list_duel_entries(duel["duel_id"])]
+    })
+    send_telegram_message(
+        GROUP_ID,
+        f"🏆 <b>Дуэль завершена!</b>\n\n<b>Победитель:</b> {html_escape(safe_username(winner_id))}\n<b>Тема:</b> {html_escape(duel['topic'])}\n<b>Приз:</b> {duel['prize']} 🪙",
+        message_thread_id=thread_id
+    )
 
 # =========================
 # ЛИСТ ЧТЕНИЯ
 # =========================
 
 def publish_reading_list(thread_id: Optional[int]) -> None:
-    items = store.pop_from_queue(5)
+    list_date = datetime.now().strftime("%d.%m.%Y")
+    items = store.publish_batch(5, list_date)
     if not items:
         send_telegram_message(GROUP_ID, "📭 <b>Лист чтения</b>\n\nОчередь пустая.", message_thread_id=thread_id)
         return
 
-    list_date = datetime.now().strftime("%d.%m.%Y")
     lines = [f"📚 <b>Лист чтения на {list_date}</b>\n"]
-
     for i, a in enumerate(items, 1):
-        author = html_escape(safe_username(int(a["user_id"])))
+        author = html_escape(a["author"])
         url = a["url"]
         lines.append(f"<b>{i})</b> 👤 <i>{author}</i>\n🔗 <a href=\"{url}\">Открыть</a>\n")
-        store.add_published(a, list_date)
-        store.add_quotes(int(a["user_id"]), 15, "Ссылка попала в лист чтения")
 
     lines.append(
         "<b>🎯 Задание:</b>\n"
@@ -992,7 +2826,97 @@ def publish_reading_list(thread_id: Optional[int]) -> None:
         "3) Получи кавычки за активность\n\n"
         "<b>⏰ Фидбек до 23:59 МСК</b>"
     )
-    send_telegram_message(GROUP_ID, "\n".join(lines), message_thread_id=thread_id)
+    resp = send_telegram_message(GROUP_ID, "\n".join(lines), message_thread_id=thread_id)
+    if not (resp and resp.get("ok")):
+        # публикация и награды уже закоммичены: повторный запуск взял бы следующие ссылки очереди
+        logger.error(f"reading list {list_date}: {len(items)} published, but the group message was not delivered")
+
+def ledger_command(text: str, admin_id: int) -> str:
+    # /ledger [user_id] - последние движения кавычек и сверка баланса с журналом
+    parts = text.split()
+    target = int(parts[1]) if len(parts) > 1 and parts[1].lstrip("-").isdigit() else admin_id
+    entries = store.list_quotes_ledger(target, 15)
+    mismatch = store.audit_quotes_ledger(target)
+    lines = [f"Журнал кавычек {target}: баланс {store.get_balance(target)}"]
+    if mismatch:
+        lines.append(f"⚠️ расхождение: сумма по журналу {mismatch[0]['ledger_sum']}")
+    for e in entries:
+        lines.append(f"{e['created_at'][:16]}  {e['delta']:+d} -> {e['balance_after']}  {e['reason']}")
+    if not entries:
+        lines.append("движений нет")
+    return "\n".join(lines)
+
+BROADCAST_USAGE = (
+    "/broadcast - последние рассылки\n"
+    "/broadcast send <текст> - черновик объявления всем пользователям\n"
+    "/broadcast confirm <id> - отправить черновик\n"
+    "/broadcast cancel <id> - отменить черновик или идущую рассылку"
+)
+
+def broadcast_command(text: str, admin_id: int) -> str:
+    # объявление всем уходит только в два шага: send создает черновик, confirm его отправляет
+    parts = text.split(None, 2)
+    sub = parts[1].lower() if len(parts) > 1 else ""
+    if sub in ("cancel", "confirm"):
+        args = parts[2].split() if len(parts) > 2 else []
+        if len(args) != 1:
+            return f"Нужен id рассылки: /broadcast {sub} <id>"
+        bid = args[0]
+        if sub == "cancel":
+            ok = store.cancel_broadcast(bid)
+            return f"Рассылка {bid} отменена." if ok else f"Рассылка {bid} не найдена или уже завершена."
+        ok = broadcasts.confirm(bid)
+        return f"Рассылка {bid} поставлена в отправку." if ok else f"Черновик {bid} не найден или уже отправлен."
+    if sub == "send":
+        body = parts[2].strip() if len(parts) > 2 else ""
+        if not body:
+            return "Нужен текст: /broadcast send <текст>"
+        b = broadcasts.create("announcement", body, "all", created_by=admin_id, draft=True)
+        if b is None:
+            return "Некому отправлять: нет пользователей без блокировки."
+        return (f"Черновик {b['id']}: {b['total']} получателей.\n\n{body}\n\n"
+                f"Отправить: /broadcast confirm {b['id']}\nОтменить: /broadcast cancel {b['id']}")
+    if sub:
+        return BROADCAST_USAGE
+    rows = store.list_broadcasts(5)
+    if not rows:
+        return "Рассылок еще не было.\n" + BROADCAST_USAGE
+    lines = ["Последние рассылки:"]
+    for r in rows:
+        line = (f"{r['id']} {r['kind']} [{r['status']}] {r['created_at'][:16]}: "
+                f"доставлено {r['delivered']}/{r['total']}, ошибок {r['failed']}, заблокировали {r['blocked']}")
+        unknown = r["total"] - r["delivered"] - r["failed"] - r["blocked"]
+        if r["status"] in ("done", "cancelled") and unknown > 0:
+            line += f", без подтверждения {unknown}"
+        lines.append(line)
+    last = broadcasts.stats()["last"]
+    if last:
+        lines.append(f"последний прогон {last['id']}: {last['delivered_per_sec']} сообщ./сек")
+    return "\n".join(lines)
+
+def sql_top_command(text: str) -> str:
+    # /sql_top [N] | on | off | reset
+    parts = text.split()
+    arg = parts[1].lower() if len(parts) > 1 else ""
+    if arg in ("on", "off"):
+        sql_profiler.enabled = arg == "on"
+        return f"SQL profiler: {arg} (slow >= {sql_profiler.slow_ms:g} ms)"
+    if arg == "reset":
+        sql_profiler.reset()
+        return "SQL profiler: статистика сброшена"
+    n = int(arg) if arg.isdigit() else 10
+    st = sql_profiler.stats()
+    top = sql_profiler.top(min(n, 30))
+    if not top:
+        state = "включен" if st["enabled"] else "выключен (/sql_top on)"
+        return f"SQL profiler {state}, данных пока нет."
+    lines = [f"SQL top по суммарному времени с {st['since'][:19]} ({'on' if st['enabled'] else 'off'}):"]
+    for i, q in enumerate(top, 1):
+        lines.append(f"\n{i}) total {q['total_ms']} ms | n={q['count']} | avg {q['avg_ms']} | max {q['max_ms']} | slow {q['slow']}")
+        lines.append(q["sql"][:300])
+        if q["plan"]:
+            lines.append("plan: " + "; ".join(q["plan"]))
+    return "\n".join(lines)[:4000]
 
 # =========================
 # ОБРАБОТКА UPDATES
@@ -1005,28 +2929,31 @@ def process_message(message: dict) -> None:
     thread_id = message.get("message_thread_id")
     message_id = message.get("message_id")
 
-    if store.is_registered(user_id):
+    ctx = store.load_user_context(user_id)
+    if ctx["registered"]:
         store.set_last_active(user_id)
+        if ctx.get("blocked_at") and chat_id == user_id:
+            # написал в личку - значит, разблокировал бота: снова получает рассылки
+            store.unblock_user(user_id)
 
     # reply-handling for duels in group
     if chat_id == GROUP_ID and "reply_to_message" in message:
         reply_to = message["reply_to_message"]
         reply_mid = reply_to.get("message_id")
-        waiting = store.get_active_duel_waiting()
-        voting = store.get_active_duel_voting()
+        route = store.route_duel_reply(int(reply_mid)) if reply_mid else None
 
-        if waiting and reply_mid and int(reply_mid) == int(waiting.get("announce_message_id") or 0):
-            if store.is_registered(user_id) and text.strip():
-                duel_accept_paragraph(user_id, text)
+        if route and route[0] == "waiting":
+            if ctx["registered"] and text.strip():
+                duel_accept_paragraph(route[1], user_id, text)
             return
 
-        if voting and reply_mid and int(reply_mid) == int(voting.get("vote_message_id") or 0):
+        if route and route[0] == "voting":
             try:
                 vote = int(text.strip())
             except Exception:
                 return
-            if store.is_registered(user_id):
-                duel_accept_vote(user_id, vote)
+            if ctx["registered"]:
+                duel_accept_vote(route[1], user_id, vote)
             return
 
     # commands
@@ -1060,26 +2987,26 @@ def process_message(message: dict) -> None:
             return
 
         # дальше нужна регистрация
-        if not store.is_registered(user_id):
+        if not ctx["registered"]:
             send_telegram_message(chat_id, "Сначала зарегистрируйся через /start в личке с ботом.", message_thread_id=thread_id)
             return
 
         if cmd == "/profile":
-            show_profile(user_id, chat_id, thread_id=thread_id if chat_id == GROUP_ID else None)
+            show_profile(user_id, chat_id, thread_id=thread_id if chat_id == GROUP_ID else None, ctx=ctx)
             return
 
         if cmd == "/balance":
-            bal = store.get_balance(user_id)
+            bal = ctx["balance"]
             send_telegram_message(chat_id, f"💰 <b>Твой баланс:</b> {bal} 🪙", message_thread_id=thread_id if chat_id == GROUP_ID else None)
             return
 
         if cmd == "/daily":
-            give_daily_reward(user_id)
+            give_daily_reward(user_id, ctx)
             return
 
         if cmd == "/submit":
             if chat_id == user_id:
-                start_article_submission(user_id)
+                start_article_submission(user_id, ctx)
             else:
                 send_telegram_message(chat_id, "Подача ссылки доступна только в личных сообщениях с ботом.", message_thread_id=thread_id)
             return
@@ -1130,12 +3057,27 @@ def process_message(message: dict) -> None:
             publish_reading_list(out_thread)
             return
 
+        if cmd == "/ledger" and user_id in ADMIN_IDS:
+            send_telegram_message(chat_id, ledger_command(text, user_id), parse_mode=None,
+                                  message_thread_id=thread_id if chat_id == GROUP_ID else None)
+            return
+
+        if cmd == "/broadcast" and user_id in ADMIN_IDS:
+            send_telegram_message(chat_id, broadcast_command(text, user_id), parse_mode=None,
+                                  message_thread_id=thread_id if chat_id == GROUP_ID else None)
+            return
+
+        if cmd == "/sql_top" and user_id in ADMIN_IDS:
+            send_telegram_message(chat_id, sql_top_command(text), parse_mode=None,
+                                  message_thread_id=thread_id if chat_id == GROUP_ID else None)
+            return
+
         send_telegram_message(chat_id, "Неизвестная команда. Напиши /help.", message_thread_id=thread_id if chat_id == GROUP_ID else None)
         return
 
     # state handling (private chat)
-    if chat_id == user_id and store.is_registered(user_id):
-        state = store.get_state(user_id)
+    if chat_id == user_id and ctx["registered"]:
+        state = ctx.get("state")
         if state == "awaiting_link":
             url = extract_first_url(text)
             if not url:
@@ -1150,14 +3092,14 @@ def process_message(message: dict) -> None:
                 )
                 return
 
-            ok, msg = can_submit_article(user_id)
+            ok, msg = can_submit_article(user_id, ctx)
             if not ok:
                 send_telegram_message(user_id, msg, parse_mode=None)
                 store.clear_state(user_id)
                 return
 
             article_id = store.add_submission_and_queue(user_id, url)
-            store.add_quotes(user_id, 10, "Подача ссылки")
+            store.add_quotes(user_id, 10, "Подача ссылки", ref=f"article:{article_id}")
 
             notify_thread = choose_thread_id(None, TOPIC_QUEUE_ID)
             send_telegram_message(
@@ -1168,7 +3110,7 @@ def process_message(message: dict) -> None:
 
             send_telegram_message(
                 user_id,
-                f"✅ <b>Ссылка добавлена в очередь!</b>\n\n<b>ID:</b> {html_escape(article_id)}\n<b>Позиция:</b> {store.queue_count()}",
+                f"✅ <b>Ссылка добавлена в очередь!</b>\n\n<b>ID:</b> {html_escape(article_id)}\n<b>Позиция:</b> {ctx['queue_total'] + 1}",
             )
 
             store.clear_state(user_id)
@@ -1200,70 +3142,945 @@ def handle_callback(callback: dict) -> None:
 
     answer_callback(callback_id, "Пока не работает.")
 
+def update_kind(data: dict) -> str:
+    if "message" in data:
+        text = (data["message"].get("text") or "").strip()
+        return normalize_command(text) if text.startswith("/") else "message"
+    if "callback_query" in data:
+        return "callback"
+    return "other"
+
+query_stats_lock = threading.Lock()
+query_stats: Dict[str, Dict[str, int]] = {}
+
+def record_update_queries(kind: str, count: int) -> None:
+    with query_stats_lock:
+        st = query_stats.get(kind)
+        if st is None:
+            # ключ - команда из текста, поэтому ограничиваем число разных ключей
+            if len(query_stats) >= 100:
+                kind = "other"
+                st = query_stats.setdefault(kind, {"updates": 0, "queries": 0, "max": 0})
+            else:
+                st = query_stats[kind] = {"updates": 0, "queries": 0, "max": 0}
+        st["updates"] += 1
+        st["queries"] += count
+        st["max"] = max(st["max"], count)
+
+def update_query_stats() -> Dict[str, Any]:
+    with query_stats_lock:
+        return {
+            k: {"updates": st["updates"], "avg": round(st["queries"] / st["updates"], 2), "max": st["max"]}
+            for k, st in query_stats.items()
+        }
+
+class UpdateDeduper:
+    def __init__(self, storage: Storage, size: int):
+        self.store = storage
+        self.size = max(1, int(size))
+        self.lock = threading.Lock()
+        self.recent: deque = deque()
+        self.recent_set: set = set()
+        self.claims = 0
+        self.duplicates = 0
+        self.pruned = 0
+
+    def _remember(self, update_id: int) -> None:
+        self.recent.append(update_id)
+        self.recent_set.add(update_id)
+        while len(self.recent) > self.size:
+            self.recent_set.discard(self.recent.popleft())
+
+    def claim(self, update_id: int) -> bool:
+        with self.lock:
+            if update_id in self.recent_set:
+                self.duplicates += 1
+                return False
+        fresh = self.store.claim_update(update_id)
+        with self.lock:
+            self._remember(update_id)
+            if not fresh:
+                self.duplicates += 1
+                return False
+            self.claims += 1
+            prune = self.claims % DEDUP_PRUNE_EVERY == 0
+        if prune:
+            removed = self.store.prune_processed_updates(time.time() - DEDUP_TTL_SECONDS)
+            with self.lock:
+                self.pruned += removed
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"claimed": self.claims, "duplicates_dropped": self.duplicates,
+                    "in_memory": len(self.recent), "pruned": self.pruned}
+
+deduper = UpdateDeduper(store, DEDUP_MEMORY_SIZE)
+
+KNOWN_COMMANDS = {"/start", "/help", "/profile", "/balance", "/daily", "/submit", "/my_posts", "/rules",
+                  "/queue", "/top", "/game", "/duel", "/publish_reading_list", "/sql_top", "/ledger",
+                  "/broadcast"}
+
+def update_metric_labels(data: dict) -> Tuple[str, str]:
+    # метки гистограммы должны иметь ограниченный набор значений
+    kind = update_kind(data)
+    if "message" in data:
+        if kind == "message":
+            return "message", "text"
+        return "message", kind if kind in KNOWN_COMMANDS else "/other"
+    if "callback_query" in data:
+        return "callback_query", "callback"
+    return "other", "other"
+
+def handle_update(data: dict) -> None:
+    store.reset_query_count()
+    started = time.perf_counter()
+    try:
+        if "update_id" in data and not deduper.claim(int(data["update_id"])):
+            logger.info(f"duplicate update {data['update_id']} dropped")
+            return
+        if "message" in data:
+            process_message(data["message"])
+        elif "callback_query" in data:
+            handle_callback(data["callback_query"])
+    finally:
+        record_update_queries(update_kind(data), store.query_count())
+        UPDATE_SECONDS.observe(time.perf_counter() - started, *update_metric_labels(data))
+
 # =========================
-# ФОН: задачи и дедлайны дуэлей
+# ОЧЕРЕДЬ UPDATES
 # =========================
 
-def background_loop():
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "reject")
+
+class UpdateLane:
+    def __init__(self, index: int, handler, maxsize: int, overflow: str):
+        self.index = index
+        self.handler = handler
+        self.q = queue.Queue(maxsize=max(1, int(maxsize)))
+        self.overflow = overflow
+        self.stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.busy_s = 0.0
+
+    def start(self) -> None:
+        threading.Thread(target=self._worker, name=f"update-lane-{self.index}", daemon=True).start()
+
+    def put(self, update: dict, block: bool = False) -> bool:
+        # False означает, что update не принят и webhook должен вернуть ошибку.
+        # block=True - ждать места в полосе независимо от UPDATE_OVERFLOW (long polling: offset двигаем только после приема)
+        try:
+            if block:
+                self.q.put(update)
+            else:
+                self.q.put_nowait(update)
+        except queue.Full:
+            if self.overflow == "reject":
+                with self.stats_lock:
+                    self.rejected += 1
+                logger.warning(f"update lane {self.index} full ({self.q.maxsize}), update rejected")
+                return False
+            if self.overflow == "drop_newest":
+                with self.stats_lock:
+                    self.dropped += 1
+                logger.warning(f"update lane {self.index} full ({self.q.maxsize}), new update dropped")
+                return True
+            try:
+                self.q.get_nowait()
+                self.q.task_done()
+                with self.stats_lock:
+                    self.dropped += 1
+                logger.warning(f"update lane {self.index} full ({self.q.maxsize}), oldest update dropped")
+            except queue.Empty:
+                pass
+            try:
+                self.q.put_nowait(update)
+            except queue.Full:
+                with self.stats_lock:
+                    self.dropped += 1
+                return True
+
+        with self.stats_lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self.q.qsize())
+        return True
+
+    def _worker(self) -> None:
+        while True:
+            update = self.q.get()
+            started = time.monotonic()
+            try:
+                self.handler(update)
+                with self.stats_lock:
+                    self.processed += 1
+            except Exception as e:
+                with self.stats_lock:
+                    self.failed += 1
+                logger.error(f"update handler error: {e}", exc_info=True)
+            finally:
+                with self.stats_lock:
+                    self.busy_s += time.monotonic() - started
+                self.q.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            return {
+                "depth": self.q.qsize(),
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "busy_s": round(self.busy_s, 2),
+            }
+
+def update_shard_key(data: dict) -> int:
+    # порядок важен в рамках пользователя (состояние awaiting_link и т.п.)
+    for key in ("message", "callback_query"):
+        obj = data.get(key)
+        if obj:
+            if (obj.get("from") or {}).get("id") is not None:
+                return int(obj["from"]["id"])
+            if (obj.get("chat") or {}).get("id") is not None:
+                return int(obj["chat"]["id"])
+    return int(data.get("update_id") or 0)
+
+class UpdateDispatcher:
+    HOT_KEYS_DECAY_EVERY = 10000
+
+    def __init__(self, handler, maxsize: int, lanes: int, overflow: str = "drop_oldest"):
+        if overflow not in OVERFLOW_POLICIES:
+            logger.warning(f"unknown UPDATE_OVERFLOW={overflow!r}, using drop_oldest")
+            overflow = "drop_oldest"
+        n = max(1, int(lanes))
+        per_lane = max(1, int(maxsize) // n)
+        self.overflow = overflow
+        self.lanes = [UpdateLane(i, handler, per_lane, overflow) for i in range(n)]
+        self.keys_lock = threading.Lock()
+        self.key_counts: Dict[int, int] = {}
+        self.seen = 0
+
+    def start(self) -> None:
+        for lane in self.lanes:
+            lane.start()
+
+    def lane_for(self, key: int) -> UpdateLane:
+        return self.lanes[key % len(self.lanes)]
+
+    def put(self, update: dict, block: bool = False) -> bool:
+        key = update_shard_key(update)
+        with self.keys_lock:
+            self.key_counts[key] = self.key_counts.get(key, 0) + 1
+            self.seen += 1
+            if self.seen % self.HOT_KEYS_DECAY_EVERY == 0:
+                # затухание: статистика отражает недавнюю нагрузку и не растет бесконечно
+                self.key_counts = {k: c // 2 for k, c in self.key_counts.items() if c // 2 > 0}
+        return self.lane_for(key).put(update, block)
+
+    def join(self) -> None:
+        for lane in self.lanes:
+            lane.q.join()
+
+    def stats(self) -> Dict[str, Any]:
+        lanes = [lane.stats() for lane in self.lanes]
+        with self.keys_lock:
+            hot = sorted(self.key_counts.items(), key=lambda kv: kv[1], reverse=True)[:5]
+        processed = [l["processed"] for l in lanes]
+        avg = sum(processed) / len(processed) if processed else 0
+        return {
+            "lanes": len(lanes),
+            "capacity_per_lane": self.lanes[0].q.maxsize,
+            "overflow": self.overflow,
+            "depth": sum(l["depth"] for l in lanes),
+            "enqueued": sum(l["enqueued"] for l in lanes),
+            "processed": sum(processed),
+            "failed": sum(l["failed"] for l in lanes),
+            "dropped": sum(l["dropped"] for l in lanes),
+            "rejected": sum(l["rejected"] for l in lanes),
+            # >1 - одна полоса нагружена сильнее среднего
+            "imbalance": round(max(processed) / avg, 2) if avg else 0.0,
+            "per_lane": lanes,
+            "hot_shards": [{"key": k, "lane": k % len(self.lanes), "updates": c} for k, c in hot],
+        }
+
+dispatcher = UpdateDispatcher(handle_update, UPDATE_QUEUE_SIZE, UPDATE_WORKERS, UPDATE_OVERFLOW)
+dispatcher.start()
+
+dispatch_lag_lock = threading.Lock()
+dispatch_lag = {"count": 0, "total_s": 0.0, "max_s": 0.0, "last_s": 0.0}
+
+def update_date(data: dict) -> Optional[int]:
+    msg = data.get("message") or (data.get("callback_query") or {}).get("message") or {}
+    return msg.get("date")
+
+def dispatch_update(data: dict, block: bool = False) -> bool:
+    # общий вход для webhook и long polling
+    sent_at = update_date(data)
+    if sent_at and "message" in data:
+        lag = max(0.0, time.time() - float(sent_at))
+        with dispatch_lag_lock:
+            dispatch_lag["count"] += 1
+            dispatch_lag["total_s"] += lag
+            dispatch_lag["max_s"] = max(dispatch_lag["max_s"], lag)
+            dispatch_lag["last_s"] = lag
+    return dispatcher.put(data, block)
+
+def dispatch_lag_stats() -> Dict[str, Any]:
+    with dispatch_lag_lock:
+        n = dispatch_lag["count"]
+        return {
+            "count": n,
+            "avg_s": round(dispatch_lag["total_s"] / n, 2) if n else 0.0,
+            "max_s": round(dispatch_lag["max_s"], 2),
+            "last_s": round(dispatch_lag["last_s"], 2),
+        }
+
+# =========================
+# LONG POLLING
+# =========================
+
+def run_polling() -> None:
+    offset_key = "poll_offset"
+    offset = int(store.get_meta(offset_key) or 0)
+    if POLL_DELETE_WEBHOOK:
+        tg("deleteWebhook", {"drop_pending_updates": False})
+    logger.info(f"long polling started, offset={offset}")
+
+    errors = 0
     while True:
+        resp = tg("getUpdates", {
+            "offset": offset,
+            "timeout": POLL_TIMEOUT,
+            "limit": POLL_LIMIT,
+            "allowed_updates": ["message", "callback_query"],
+        }, timeout=POLL_TIMEOUT + 10)
+
+        if not resp or not resp.get("ok"):
+            errors += 1
+            if resp and int(resp.get("error_code") or 0) == 409:
+                logger.error("getUpdates conflict: webhook is set (POLL_DELETE_WEBHOOK=1 removes it) or another poller runs")
+            time.sleep(telegram_retry_after(resp) or min(60, 2 ** min(errors, 6)))
+            continue
+        errors = 0
+
+        updates = resp.get("result") or []
+        if not updates:
+            continue
+
+        for upd in updates:
+            # при переполнении полосы не теряем update, а ждем места: политика UPDATE_OVERFLOW - только для webhook
+            dispatch_update(upd, block=True)
+
+        offset = int(updates[-1]["update_id"]) + 1
+        store.set_meta(offset_key, str(offset))
+        lag = dispatch_lag_stats()
+        logger.info(f"poll batch: {len(updates)} updates, offset={offset}, last lag {lag['last_s']}s")
+
+# =========================
+# ФОН: задачи и дедлайны дуэлей
+# =========================
+
+REMINDER_TEXT = "🔔 Можно подать новую ссылку. Используй /submit"
+
+def broadcast_outcome(resp: Optional[dict]) -> str:
+    if resp and resp.get("ok"):
+        return "sent"
+    # 403: бот заблокирован или аккаунт удален - повторять бессмысленно
+    if resp and int(resp.get("error_code") or 0) == 403:
+        return "blocked"
+    return "failed"
+
+class BroadcastEngine:
+    # одна рассылка за раз на лидере: окно из concurrency сообщений в outbound (bulk-полоса),
+    # темп ограничен своим TokenBucket, прогресс пишется в broadcast_recipients пачками по flush
+    def __init__(self, storage: Storage, concurrency: int, rate: float, flush: int):
+        self.store = storage
+        self.concurrency = max(1, int(concurrency))
+        self.bucket = TokenBucket(rate, max(1.0, float(rate)))  # только поток рассылки
+        self.flush_every = max(1, int(flush))
+        self.enabled = threading.Event()
+        self.wake = threading.Event()
+        self.guard = lambda: True
+        self.lock = threading.Lock()
+        self.current: Optional[Dict[str, Any]] = None
+        self.totals = {"sent": 0, "failed": 0, "blocked": 0}
+        self.finished = 0
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    def create(self, kind: str, text: str, audience: str, params: Optional[Dict[str, Any]] = None,
+               created_by: Optional[int] = None, parse_mode: Optional[str] = None,
+               draft: bool = False) -> Optional[Dict[str, Any]]:
+        b = self.store.create_broadcast(kind, text, audience, params, created_by, parse_mode, draft)
+        if b is not None and not draft:
+            self.wake.set()
+        return b
+
+    def confirm(self, broadcast_id: str) -> bool:
+        ok = self.store.confirm_broadcast(broadcast_id)
+        if ok:
+            self.wake.set()
+        return ok
+
+    def resume(self) -> None:
+        self.enabled.set()
+        self.wake.set()
+
+    def pause(self) -> None:
+        self.enabled.clear()
+        self.wake.set()
+
+    def _active(self) -> bool:
+        return self.enabled.is_set() and self.guard()
+
+    def run_forever(self) -> None:
+        while True:
+            self.enabled.wait()
+            try:
+                self.wake.clear()
+                b = self.store.next_broadcast()
+                if b is None:
+                    self.wake.wait(timeout=BROADCAST_POLL_SECONDS)
+                    continue
+                if not self.guard():
+                    logger.warning(f"broadcast {b['id']} postponed: leader lease lost")
+                    self.pause()
+                    continue
+                self._deliver(b)
+            except Exception as e:
+                logger.error(f"broadcast error: {e}", exc_info=True)
+                time.sleep(1)
+
+    def _deliver(self, b: Dict[str, Any]) -> None:
+        bid = b["id"]
+        self.store.start_broadcast(bid)
+        started = time.monotonic()
+        run = {"sent": 0, "failed": 0, "blocked": 0}
+        with self.lock:
+            self.current = {"id": bid, "kind": b["kind"], "total": int(b["total"]), "started": started, "run": run,
+                            "done_before": int(b["delivered"]) + int(b["failed"]) + int(b["blocked"])}
+        inflight: Dict[Future, int] = {}
+        results: List[Tuple[int, str]] = []
+        pending: deque = deque()
+        claimed: deque = deque()  # помечены sending, еще не отданы в outbound
+        after = -1
+        exhausted = stopped = False
         try:
-            now_utc = datetime.utcnow()
-
-            # Лист чтения: 19:00 МСК = 16:00 UTC
-            key_publish = "last_publish_date_utc"
-            today_utc = now_utc.date().isoformat()
-            if now_utc.hour == 16 and now_utc.minute == 0:
-                last = store.get_meta(key_publish)
-                if last != today_utc:
-                    if store.queue_count() > 0:
-                        publish_reading_list(choose_thread_id(None, TOPIC_QUEUE_ID))
-                    store.set_meta(key_publish, today_utc)
-
-            # Сброс published: 00:00 МСК = 21:00 UTC (условно)
-            key_reset = "last_reset_date_utc"
-            if now_utc.hour == 21 and now_utc.minute == 0:
-                last = store.get_meta(key_reset)
-                if last != today_utc:
-                    store.set_meta(key_reset, today_utc)
-
-            # Напоминания о возможности подать
-            # простой проход по всем пользователям с last_submit_at
-            users_rows = store._query_all("SELECT user_id, last_submit_at, submit_notified_at FROM user_state WHERE last_submit_at IS NOT NULL")
-            now_local = datetime.now()
-            for r in users_rows:
-                uid = int(r["user_id"])
-                try:
-                    last_submit = datetime.fromisoformat(r["last_submit_at"])
-                except Exception:
+            while True:
+                delay = 0.0
+                if not stopped and not self._active():
+                    stopped = True
+                while not stopped and len(inflight) < self.concurrency:
+                    if not pending and not exhausted:
+                        current = self.store.get_broadcast(bid)
+                        if not current or current["status"] != "running":
+                            stopped = True  # отменена
+                            break
+                        ids = self.store.list_broadcast_pending(bid, after, self.flush_every)
+                        exhausted = len(ids) < self.flush_every
+                        if ids:
+                            after = ids[-1]
+                            pending.extend(ids)
+                    if not claimed:
+                        if not pending:
+                            break
+                        take = [pending.popleft() for _ in range(min(len(pending), self.concurrency))]
+                        self.store.move_broadcast_recipients(bid, take, "pending", "sending")
+                        claimed.extend(take)
+                    delay = self.bucket.delay(time.monotonic())
+                    if delay > 0:
+                        break
+                    self.bucket.take(time.monotonic())
+                    uid = claimed.popleft()
+                    payload = {"chat_id": uid, "text": b["text"], "disable_web_page_preview": True}
+                    if b.get("parse_mode"):
+                        payload["parse_mode"] = b["parse_mode"]
+                    inflight[outbound.submit("sendMessage", payload, chat_id=uid, priority=PRIORITY_BULK)] = uid
+
+                if not inflight:
+                    if stopped or (exhausted and not pending and not claimed):
+                        break
+                    time.sleep(delay)
                     continue
-                hours = (now_local - last_submit).total_seconds() / 3600
-                if hours >= 48 and not store.queue_has_user(uid):
-                    last_notified = None
-                    if r["submit_notified_at"]:
-                        try:
-                            last_notified = datetime.fromisoformat(r["submit_notified_at"])
-                        except Exception:
-                            last_notified = None
-                    if (not last_notified) or ((now_local - last_notified).total_seconds() > 3600):
-                        resp = send_telegram_message(uid, "🔔 Можно подать новую ссылку. Используй /submit")
-                        if resp and resp.get("ok"):
-                            store.set_submit_notified_at(uid, now_local)
-
-            # Дуэли: закрыть прием/голосование по дедлайнам
-            waiting_due, voting_due = store.list_duels_due(now_utc)
-
-            for d in waiting_due:
-                duel_finish_submissions(d)
-
-            for d in voting_due:
-                duel_finish_voting(d)
 
-        except Exception as e:
-            logger.error(f"background_loop error: {e}", exc_info=True)
+                done, _ = futures_wait(list(inflight), timeout=delay if delay > 0 else 1.0, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    uid = inflight.pop(fut)
+                    try:
+                        outcome = broadcast_outcome(fut.result())
+                    except Exception:
+                        outcome = "failed"
+                    results.append((uid, outcome))
+                    run[outcome] += 1
+                if len(results) >= self.flush_every:
+                    self.store.record_broadcast_results(b, results)
+                    results = []
+        finally:
+            # недописанные результаты сохраняем и при ошибке; неотправленных возвращаем в pending
+            self.store.record_broadcast_results(b, results)
+            self.store.move_broadcast_recipients(bid, list(claimed), "sending", "pending")
+            elapsed = time.monotonic() - started
+            with self.lock:
+                for k, v in run.items():
+                    self.totals[k] += v
+                self.current = None
+
+        if not stopped:
+            self.store.finish_broadcast(bid)
+        report = {
+            "id": bid,
+            "kind": b["kind"],
+            "status": "interrupted" if stopped else "done",
+            "delivered": run["sent"],
+            "failed": run["failed"],
+            "blocked": run["blocked"],
+            "seconds": round(elapsed, 1),
+            "delivered_per_sec": round(run["sent"] / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+        with self.lock:
+            self.finished += 0 if stopped else 1
+            self.last_report = report
+        logger.info(f"broadcast {bid} ({b['kind']}) {report['status']}: delivered {run['sent']}, failed {run['failed']}, "
+                    f"blocked {run['blocked']} in {report['seconds']}s ({report['delivered_per_sec']}/s)")
 
-        time.sleep(20)
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            cur = None
+            if self.current is not None:
+                c = self.current
+                elapsed = time.monotonic() - c["started"]
+                done = c["done_before"] + sum(c["run"].values())
+                cur = {
+                    "id": c["id"],
+                    "kind": c["kind"],
+                    "progress": f"{done}/{c['total']}",
+                    "delivered_per_sec": round(c["run"]["sent"] / elapsed, 2) if elapsed > 0 else 0.0,
+                }
+            return {
+                "enabled": self.enabled.is_set(),
+                "current": cur,
+                "finished": self.finished,
+                "delivered": self.totals["sent"],
+                "failed": self.totals["failed"],
+                "blocked": self.totals["blocked"],
+                "last": self.last_report,
+            }
 
-threading.Thread(target=background_loop, daemon=True).start()
+broadcasts = BroadcastEngine(store, BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_FLUSH)
+
+def enqueue_due_reminders(now_local: datetime) -> Optional[Dict[str, Any]]:
+    # отправляет BroadcastEngine; задача планировщика только фиксирует получателей
+    b = broadcasts.create("reminder", REMINDER_TEXT, "reminders", {
+        "now": now_local.isoformat(),
+        "limit": REMINDER_BATCH_SIZE * REMINDER_MAX_BATCHES,
+        "next_at": (now_local + timedelta(minutes=REMINDER_REPEAT_MINUTES)).isoformat(),
+    }, parse_mode="HTML")
+    if b is not None:
+        logger.info(f"submit reminders queued: {b['total']} (broadcast {b['id']})")
+    return b
+
+def utc_timestamp(dt_utc: datetime) -> float:
+    # дедлайны дуэлей хранятся как наивное UTC-время
+    return dt_utc.replace(tzinfo=timezone.utc).timestamp()
+
+def next_daily_run(spec: str, after: float) -> float:
+    # spec "HH:MM" по UTC; ближайший момент строго после after
+    hh, mm = (int(x) for x in spec.split(":", 1))
+    base = datetime.fromtimestamp(after, tz=timezone.utc)
+    candidate = base.replace(hour=hh, minute=mm, second=0, microsecond=0)
+    if candidate.timestamp() <= after:
+        candidate += timedelta(days=1)
+    return candidate.timestamp()
+
+class JobScheduler:
+    def __init__(self, storage: Storage):
+        self.store = storage
+        self.cond = threading.Condition()
+        self.heap: List[Tuple[float, int, str]] = []
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.handlers: Dict[str, Any] = {}
+        self.recurring: Dict[str, Tuple[str, str, str]] = {}
+        self.seq = 0
+        self.synced_at = 0.0
+        self.stats_by_handler: Dict[str, Dict[str, Any]] = {}
+        self.enabled = threading.Event()
+        self.guard = lambda: True
+
+    def register(self, handler: str, fn) -> None:
+        self.handlers[handler] = fn
+
+    def add_recurring(self, name: str, handler: str, kind: str, spec: str) -> None:
+        # kind: "daily" (spec "HH:MM" UTC) или "interval" (spec - секунды)
+        self.recurring[name] = (handler, kind, spec)
+
+    def _compute_next(self, kind: str, spec: str, after: float) -> float:
+        if kind == "daily":
+            return next_daily_run(spec, after)
+        return after + float(spec)
+
+    def _push(self, job: Dict[str, Any]) -> None:
+        self.jobs[job["name"]] = job
+        self.seq += 1
+        heapq.heappush(self.heap, (float(job["next_run"]), self.seq, job["name"]))
+
+    def sync(self) -> None:
+        # таблица jobs - источник истины: задачи могли добавить или выполнить другие процессы
+        rows = {j["name"]: j for j in self.store.list_jobs()}
+        now = time.time()
+        for name, (handler, kind, spec) in self.recurring.items():
+            row = rows.get(name)
+            # сохраненный next_run в прошлом означает пропущенный запуск - он выполнится сразу
+            if row is None or row["handler"] != handler or row["kind"] != kind or row["spec"] != spec:
+                next_run = self._compute_next(kind, spec, now)
+                self.store.upsert_job(name, handler, kind, spec, {}, next_run)
+                rows[name] = {"name": name, "handler": handler, "kind": kind, "spec": spec, "payload": {}, "next_run": next_run}
+        with self.cond:
+            self.jobs = {}
+            self.heap = []
+            for job in rows.values():
+                self._push(job)
+            self.synced_at = time.monotonic()
+            self.cond.notify_all()
+
+    def schedule_once(self, name: str, handler: str, run_at: float, payload: Dict[str, Any]) -> None:
+        self.store.upsert_job(name, handler, "once", None, payload, run_at)
+        with self.cond:
+            self._push({"name": name, "handler": handler, "kind": "once", "spec": None, "payload": payload, "next_run": run_at})
+            self.cond.notify_all()
+
+    def resume(self) -> None:
+        self.synced_at = 0.0
+        self.enabled.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def pause(self) -> None:
+        self.enabled.clear()
+        with self.cond:
+            self.cond.notify_all()
+
+    def _next_due(self) -> Optional[Dict[str, Any]]:
+        while True:
+            if not self.enabled.is_set():
+                return None
+            if time.monotonic() - self.synced_at >= JOB_SYNC_SECONDS:
+                self.sync()
+            job = self._pop_due()
+            if job is not None:
+                return job
+
+    def _pop_due(self) -> Optional[Dict[str, Any]]:
+        # None - пора перечитать таблицу jobs
+        with self.cond:
+            while time.monotonic() - self.synced_at < JOB_SYNC_SECONDS and self.enabled.is_set():
+                while self.heap:
+                    run_at, _, name = self.heap[0]
+                    job = self.jobs.get(name)
+                    if job is None or float(job["next_run"]) != run_at:
+                        heapq.heappop(self.heap)  # устаревшая запись после перепланирования
+                        continue
+                    break
+                if not self.heap:
+                    self.cond.wait(timeout=JOB_SYNC_SECONDS)
+                    continue
+                run_at, _, name = self.heap[0]
+                delay = run_at - time.time()
+                if delay > 0:
+                    self.cond.wait(timeout=min(delay, JOB_SYNC_SECONDS))
+                    continue
+                heapq.heappop(self.heap)
+                return self.jobs.pop(name)
+        return None
+
+    def _run_job(self, job: Dict[str, Any]) -> None:
+        handler = job["handler"]
+        fn = self.handlers.get(handler)
+        started = time.time()
+        lag_ms = max(0.0, (started - float(job["next_run"])) * 1000)
+        ok = True
+        if fn is None:
+            logger.error(f"job {job['name']}: unknown handler {handler}")
+            ok = False
+        else:
+            try:
+                fn(job.get("payload") or {})
+            except Exception as e:
+                ok = False
+                logger.error(f"job {job['name']} error: {e}", exc_info=True)
+        elapsed_ms = (time.time() - started) * 1000
+        self._record(handler, elapsed_ms, lag_ms, ok)
+
+        if job["kind"] == "once":
+            if ok:
+                self.store.delete_job(job["name"])
+            else:
+                self._retry_once(job, started)
+            return
+        # пропущенные запуски догоняем одним запуском, следующий - по расписанию от текущего момента
+        next_run = self._compute_next(job["kind"], job["spec"], time.time())
+        self.store.upsert_job(job["name"], handler, job["kind"], job["spec"], job.get("payload") or {}, next_run, started)
+        with self.cond:
+            if job["name"] not in self.jobs:
+                self._push(dict(job, next_run=next_run))
+
+    def _retry_once(self, job: Dict[str, Any], started: float) -> None:
+        # номер попытки хранится в payload: переживает рестарт и смену лидера
+        payload = dict(job.get("payload") or {})
+        attempt = int(payload.get("_attempt", 0)) + 1
+        if attempt > JOB_MAX_RETRIES:
+            logger.error(f"job {job['name']} failed {attempt} times, giving up")
+            self.store.delete_job(job["name"])
+            return
+        payload["_attempt"] = attempt
+        retry_at = time.time() + min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+        self.store.upsert_job(job["name"], job["handler"], "once", None, payload, retry_at, started)
+        with self.cond:
+            if job["name"] not in self.jobs:
+                self._push(dict(job, payload=payload, next_run=retry_at))
+        logger.warning(f"job {job['name']} failed, retry {attempt}/{JOB_MAX_RETRIES} "
+                       f"at {datetime.fromtimestamp(retry_at, tz=timezone.utc).isoformat()}")
+
+    def _record(self, handler: str, elapsed_ms: float, lag_ms: float, ok: bool) -> None:
+        with self.cond:
+            st = self.stats_by_handler.get(handler)
+            if st is None:
+                st = self.stats_by_handler[handler] = {"runs": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                       "last_ms": 0.0, "last_lag_ms": 0.0, "last_run": None}
+            st["runs"] += 1
+            st["errors"] += 0 if ok else 1
+            st["total_ms"] += elapsed_ms
+            st["max_ms"] = max(st["max_ms"], elapsed_ms)
+            st["last_ms"] = elapsed_ms
+            st["last_lag_ms"] = lag_ms
+            st["last_run"] = datetime.now().isoformat()
+        JOB_SECONDS.observe(elapsed_ms / 1000.0, handler)
+
+    def run_forever(self) -> None:
+        while True:
+            self.enabled.wait()
+            try:
+                job = self._next_due()
+                if job is None:
+                    continue
+                if not self.guard():
+                    # аренда лидера истекла: задачу выполнит новый лидер по таблице jobs
+                    logger.warning(f"job {job['name']} skipped: leader lease lost")
+                    self.pause()
+                    continue
+                self._run_job(job)
+            except Exception as e:
+                logger.error(f"scheduler error: {e}", exc_info=True)
+                time.sleep(1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            handlers = {
+                h: {
+                    "runs": st["runs"],
+                    "errors": st["errors"],
+                    "avg_ms": round(st["total_ms"] / st["runs"], 1) if st["runs"] else 0.0,
+                    "max_ms": round(st["max_ms"], 1),
+                    "last_ms": round(st["last_ms"], 1),
+                    "last_lag_ms": round(st["last_lag_ms"], 1),
+                    "last_run": st["last_run"],
+                }
+                for h, st in self.stats_by_handler.items()
+            }
+            pending = sorted(
+                ({"name": j["name"], "next_run": datetime.fromtimestamp(float(j["next_run"]), tz=timezone.utc).isoformat()}
+                 for j in self.jobs.values()),
+                key=lambda x: x["next_run"]
+            )[:20]
+        return {"handlers": handlers, "pending": pending}
+
+# ---- задачи ----
+
+def job_publish_reading_list(payload: Dict[str, Any]) -> None:
+    # Лист чтения: 19:00 МСК = 16:00 UTC
+    key_publish = "last_publish_date_utc"
+    today_utc = datetime.utcnow().date().isoformat()
+    if store.get_meta(key_publish) != today_utc:
+        if store.queue_count() > 0:
+            publish_reading_list(choose_thread_id(None, TOPIC_QUEUE_ID))
+        store.set_meta(key_publish, today_utc)
+
+def job_reset_published(payload: Dict[str, Any]) -> None:
+    # Сброс published: 00:00 МСК = 21:00 UTC (условно)
+    store.set_meta("last_reset_date_utc", datetime.utcnow().date().isoformat())
+
+def job_submit_reminders(payload: Dict[str, Any]) -> None:
+    enqueue_due_reminders(datetime.now())
+
+def job_prune_broadcasts(payload: Dict[str, Any]) -> None:
+    # напоминания создают рассылку каждые 20 секунд: без чистки таблицы растут на users x 24 строк в день
+    n, recipients = store.prune_broadcasts(datetime.now() - timedelta(days=BROADCAST_RETENTION_DAYS))
+    if n:
+        logger.info(f"pruned {n} broadcasts, {recipients} recipient rows")
+
+def job_duel_submissions(payload: Dict[str, Any]) -> None:
+    duel = store.get_duel_by_id(payload.get("duel_id", ""))
+    if duel and duel["status"] == "waiting":
+        duel_finish_submissions(duel)
+
+def job_duel_voting(payload: Dict[str, Any]) -> None:
+    duel = store.get_duel_by_id(payload.get("duel_id", ""))
+    if duel and duel["status"] == "voting":
+        duel_finish_voting(duel)
+
+def job_duel_deadlines_sweep(payload: Dict[str, Any]) -> None:
+    # страховка для дуэлей без one-shot задачи (например, созданных до появления планировщика)
+    waiting_due, voting_due = store.list_duels_due(datetime.utcnow())
+    for d in waiting_due:
+        duel_finish_submissions(d)
+    for d in voting_due:
+        duel_finish_voting(d)
+
+scheduler = JobScheduler(store)
+scheduler.register("publish_reading_list", job_publish_reading_list)
+scheduler.register("reset_published", job_reset_published)
+scheduler.register("submit_reminders", job_submit_reminders)
+scheduler.register("prune_broadcasts", job_prune_broadcasts)
+scheduler.register("duel_submissions", job_duel_submissions)
+scheduler.register("duel_voting", job_duel_voting)
+scheduler.register("duel_deadlines_sweep", job_duel_deadlines_sweep)
+scheduler.add_recurring("publish_reading_list", "publish_reading_list", "daily", "16:00")
+scheduler.add_recurring("reset_published", "reset_published", "daily", "21:00")
+scheduler.add_recurring("submit_reminders", "submit_reminders", "interval", "20")
+scheduler.add_recurring("prune_broadcasts", "prune_broadcasts", "daily", "00:30")
+scheduler.add_recurring("duel_deadlines_sweep", "duel_deadlines_sweep", "interval", "60")
+
+def seed_duel_jobs() -> None:
+    for d in store.list_active_duels():
+        if d["status"] == "waiting" and d.get("submissions_deadline"):
+            scheduler.schedule_once(f"duel_submissions:{d['duel_id']}", "duel_submissions",
+                                    utc_timestamp(datetime.fromisoformat(d["submissions_deadline"])), {"duel_id": d["duel_id"]})
+        elif d["status"] == "voting" and d.get("vote_deadline"):
+            scheduler.schedule_once(f"duel_voting:{d['duel_id']}", "duel_voting",
+                                    utc_timestamp(datetime.fromisoformat(d["vote_deadline"])), {"duel_id": d["duel_id"]})
+
+# ---- лидер ----
+
+class LeaderElector:
+    def __init__(self, storage: Storage, name: str, ttl: float, on_elected, on_demoted):
+        self.store = storage
+        self.name = name
+        self.ttl = float(ttl)
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.leader_since: Optional[str] = None
+        self.valid_until = 0.0
+        self.elections = 0
+
+    def holds_lease(self) -> bool:
+        # считаем аренду своей с запасом в один heartbeat до ее истечения в БД
+        return self.is_leader and time.monotonic() < self.valid_until
+
+    def _tick(self) -> None:
+        started = time.monotonic()
+        try:
+            acquired = self.store.try_acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            logger.error(f"leader lease heartbeat failed: {e}")
+            acquired = False
+        if acquired:
+            self.valid_until = started + self.ttl * 2 / 3
+            if not self.is_leader:
+                self.is_leader = True
+                self.elections += 1
+                self.leader_since = datetime.now().isoformat()
+                logger.info(f"leader lease '{self.name}' acquired by {self.holder}")
+                self.on_elected()
+        elif self.is_leader:
+            self.is_leader = False
+            self.leader_since = None
+            logger.warning(f"leader lease '{self.name}' lost by {self.holder}")
+            self.on_demoted()
+
+    def run_forever(self) -> None:
+        while True:
+            self._tick()
+            time.sleep(self.ttl / 3)
+
+    def release(self) -> None:
+        if self.is_leader:
+            self.is_leader = False
+            self.on_demoted()
+            try:
+                self.store.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.warning(f"leader lease release failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lease = self.store.get_lease(self.name) or {}
+        return {
+            "holder": self.holder,
+            "is_leader": self.is_leader,
+            "leader_since": self.leader_since,
+            "elections": self.elections,
+            "current_holder": lease.get("holder"),
+        }
+
+def on_leader_elected() -> None:
+    seed_duel_jobs()
+    scheduler.resume()
+    broadcasts.resume()
+
+def on_leader_demoted() -> None:
+    scheduler.pause()
+    broadcasts.pause()
+
+leader = LeaderElector(store, "background", LEADER_LEASE_TTL, on_leader_elected, on_leader_demoted)
+scheduler.guard = leader.holds_lease
+broadcasts.guard = leader.holds_lease
+
+def start_background() -> None:
+    threading.Thread(target=scheduler.run_forever, name="scheduler", daemon=True).start()
+    threading.Thread(target=broadcasts.run_forever, name="broadcasts", daemon=True).start()
+    threading.Thread(target=leader.run_forever, name="leader-elector", daemon=True).start()
+    atexit.register(leader.release)
+
+# python app.py --check-schema - разовая проверка: не берем аренду лидера и не запускаем задачи
+CHECK_SCHEMA_RUN = __name__ == "__main__" and "--check-schema" in sys.argv
+
+if RUN_BACKGROUND and not CHECK_SCHEMA_RUN:
+    start_background()
+
+# gauges снимаются из stats() уже созданных компонентов
+def _dispatcher_overflow() -> List[Tuple[Tuple[str], int]]:
+    st = dispatcher.stats()
+    return [(("dropped",), st["dropped"]), (("rejected",), st["rejected"])]
+
+def _broadcast_outcomes() -> List[Tuple[Tuple[str], int]]:
+    st = broadcasts.stats()
+    return [((k,), st[k]) for k in ("delivered", "failed", "blocked")]
+
+metrics.add(GaugeFunc("clubbot_update_queue_depth", "Updates waiting in dispatcher lanes", ("lane",),
+                      lambda: [((lane.index,), lane.q.qsize()) for lane in dispatcher.lanes]))
+metrics.add(GaugeFunc("clubbot_updates_overflow_total", "Updates dropped or rejected on lane overflow", ("reason",),
+                      _dispatcher_overflow, kind="counter"))
+metrics.add(GaugeFunc("clubbot_outbound_queued", "Outbound Bot API calls waiting per lane", ("lane",),
+                      lambda: list(((k,), v) for k, v in outbound.stats()["queued"].items())))
+metrics.add(GaugeFunc("clubbot_updates_duplicate_total", "Redelivered updates dropped by update_id", (),
+                      lambda: [((), deduper.stats()["duplicates_dropped"])], kind="counter"))
+metrics.add(GaugeFunc("clubbot_sqlite_writer_queued", "Write operations waiting for the writer thread", (),
+                      lambda: [((), store.writer.q.qsize())]))
+metrics.add(GaugeFunc("clubbot_sqlite_commits_total", "Group commits by the writer thread", (),
+                      lambda: [((), store.writer.stats()["commits"])], kind="counter"))
+metrics.add(GaugeFunc("clubbot_sqlite_read_connections", "Read-only pool connections by state", ("state",),
+                      lambda: [(("idle",), store.readers.stats()["idle"]), (("in_use",), store.readers.stats()["in_use"])]))
+metrics.add(GaugeFunc("clubbot_write_behind_pending", "last_active writes waiting for flush", (),
+                      lambda: [((), store.write_behind_stats()["pending"])]))
+metrics.add(GaugeFunc("clubbot_broadcast_messages_total", "Broadcast messages by outcome", ("outcome",),
+                      _broadcast_outcomes, kind="counter"))
+metrics.add(GaugeFunc("clubbot_is_leader", "1 if this process holds the background lease", (),
+                      lambda: [((), 1 if leader.is_leader else 0)]))
 
 # =========================
 # FLASK ROUTES
@@ -1271,30 +4088,75 @@ threading.Thread(target=background_loop, daemon=True).start()
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    started = time.perf_counter()
     try:
         data = request.get_json(force=True, silent=True) or {}
         logger.info(f"webhook keys: {list(data.keys())}")
 
-        if "message" in data:
-            process_message(data["message"])
-        elif "callback_query" in data:
-            handle_callback(data["callback_query"])
+        if not dispatch_update(data):
+            return jsonify({"error": "overloaded"}), 503
 
         return jsonify({"status": "ok"}), 200
     except Exception as e:
         logger.error(f"webhook error: {e}", exc_info=True)
         return jsonify({"error": str(e)}), 500
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+HEALTH_PSEUDONYM_KEY = os.urandom(16)
+
+def health_pseudonym(value: Any) -> str:
+    # стабилен в пределах процесса (видно, что это один и тот же ключ), но не обращается в исходный id
+    return hmac.new(HEALTH_PSEUDONYM_KEY, str(value).encode("utf-8"), "sha256").hexdigest()[:10]
+
+def health_detail_allowed() -> bool:
+    token = request.headers.get("X-Health-Token") or request.args.get("token") or ""
+    return bool(HEALTH_TOKEN) and hmac.compare_digest(token.encode("utf-8"), HEALTH_TOKEN.encode("utf-8"))
+
+def redact_health(data: Dict[str, Any]) -> Dict[str, Any]:
+    for shard in data["updates"].get("hot_shards", []):
+        shard["key"] = health_pseudonym(shard["key"])
+    # имена разовых задач содержат duel_id, а в нем id инициатора: оставляем только тип задачи
+    for job in data["jobs"].get("pending", []):
+        kind, sep, ref = job["name"].partition(":")
+        if sep:
+            job["name"] = f"{kind}:{health_pseudonym(ref)}"
+    lead = data["leader"]
+    for k in ("holder", "current_holder"):
+        if lead.get(k):
+            lead[k] = health_pseudonym(lead[k])
+    return data
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({
+    data = {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "db_path": DB_PATH,
         "users": store._query_one("SELECT COUNT(*) AS c FROM users")["c"],
         "queue": store.queue_count(),
+        "updates": dispatcher.stats(),
+        "telegram": tg_client.stats(),
+        "outbound": outbound.stats(),
+        "write_behind": store.write_behind_stats(),
+        "writer": store.writer.stats(),
+        "read_pool": store.readers.stats(),
+        "name_cache": store.names.stats(),
+        "jobs": scheduler.stats(),
+        "duels": store.duels.stats(),
+        "queries_per_update": update_query_stats(),
+        "dispatch_lag": dispatch_lag_stats(),
+        "dedup": deduper.stats(),
+        "leader": leader.stats(),
+        "broadcasts": broadcasts.stats(),
+        "sql_profile": sql_profiler.stats(),
         "version": "3.0-sqlite"
-    }), 200
+    }
+    return jsonify(data if health_detail_allowed() else redact_health(data)), 200
 
 @app.route("/", methods=["GET"])
 def home():
@@ -1306,6 +4168,27 @@ def home():
         "<p><a href='/health'>Health</a></p>"
     )
 
+def check_schema() -> int:
+    with store.readers.connection() as conn:
+        version = schema_version(conn)
+        report = explain_hot_queries(conn)
+    print(f"schema_version: {version} (latest {MIGRATIONS[-1][0]})")
+    bad = 0
+    for item in report:
+        mark = "FULL SCAN" if item["full_scan"] else "ok"
+        print(f"[{mark}] {item['query']}")
+        for line in item["plan"]:
+            print(f"    {line}")
+        bad += int(item["full_scan"])
+    return 1 if bad else 0
+
 if __name__ == "__main__":
+    if "--check-schema" in sys.argv:
+        sys.exit(check_schema())
+
+    if "--poll" in sys.argv:
+        run_polling()
+        sys.exit(0)
+
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False)
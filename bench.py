@@ -0,0 +1,322 @@
+# Нагрузочный прогон бота целиком: синтетические пользователи -> POST /webhook (Flask test client)
+# -> очередь updates -> обработчики -> SQLite. Telegram подменен заглушкой tg(), БД каждый раз новая.
+#
+#   python bench.py --users 500 --rounds 3 --duels 10 --out bench-result.json
+#
+# Результат - JSON: updates/sec по фазам, p50/p95/p99 задержки по командам, рост размера БД.
+# Сравнение прогонов: python bench.py ... --out new.json, затем diff/jq с предыдущим файлом.
+# С деградацией Telegram: python fake_telegram.py --latency lognormal:80:0.5 --rate-429 0.05 &
+#                         python bench.py --tg-url http://127.0.0.1:8081 --real-limits
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+GROUP_ID = -1000000000777
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="ClubBot end-to-end load benchmark")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--rounds", type=int, default=3, help="раундов смешанных команд на пользователя")
+    p.add_argument("--duels", type=int, default=5)
+    p.add_argument("--duel-size", type=int, default=5, help="участников в каждой дуэли")
+    p.add_argument("--submit-share", type=float, default=0.3, help="доля пользователей, подающих ссылку")
+    p.add_argument("--clients", type=int, default=4, help="параллельных отправителей webhook")
+    p.add_argument("--tg-latency-ms", type=float, default=0.0, help="задержка заглушки tg()")
+    p.add_argument("--tg-url", default="", help="вместо заглушки слать в Bot API по этому адресу (fake_telegram.py)")
+    p.add_argument("--real-limits", action="store_true", help="оставить лимиты исходящих сообщений как в проде")
+    p.add_argument("--db", default="", help="путь к БД (по умолчанию временный файл)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", default="", help="куда записать JSON (по умолчанию только stdout)")
+    return p.parse_args()
+
+
+def configure_env(args: argparse.Namespace) -> str:
+    # настройки читаются app.py при импорте, поэтому выставляем их до import app
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="clubbot-bench-"), "bench.sqlite3")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.environ["DB_PATH"] = db_path
+    os.environ["TELEGRAM_TOKEN"] = "bench"
+    os.environ["GROUP_ID"] = str(GROUP_ID)
+    os.environ["ADMIN_IDS"] = "1"
+    os.environ["RUN_BACKGROUND"] = "0"
+    if args.tg_url:
+        os.environ["TELEGRAM_API_BASE"] = args.tg_url
+    if not args.real_limits:
+        for key in ("TG_GLOBAL_RATE", "TG_CHAT_RATE", "TG_GROUP_RATE_PER_MIN", "TG_CHAT_BURST"):
+            os.environ[key] = "1000000"
+    return db_path
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+def summarize(samples: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    out = {}
+    for label, values in sorted(samples.items()):
+        out[label] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50), 3),
+            "p95_ms": round(percentile(values, 95), 3),
+            "p99_ms": round(percentile(values, 99), 3),
+            "max_ms": round(max(values), 3) if values else 0.0,
+        }
+    return out
+
+
+def db_size(db_path: str) -> int:
+    return sum(os.path.getsize(db_path + s) for s in ("", "-wal") if os.path.exists(db_path + s))
+
+
+class Bench:
+    def __init__(self, app_module, args: argparse.Namespace):
+        self.app = app_module
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.client = app_module.app.test_client()
+        self.lock = threading.Lock()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.tg_message_id = 1000000
+        self.tg_calls: Dict[str, int] = {}
+        # update_id -> (метка, время POST); заполняется до отправки, читается обработчиком
+        self.pending: Dict[int, Tuple[str, float]] = {}
+        self.e2e: Dict[str, List[float]] = {}
+        self.handle: Dict[str, List[float]] = {}
+        self.http_errors = 0
+        self.handler_errors = 0
+        self.phases: Dict[str, Dict[str, Any]] = {}
+
+    # ---- заглушка Bot API ----
+
+    def fake_tg(self, method: str, payload: dict, timeout: int = 12) -> dict:
+        if self.args.tg_latency_ms:
+            time.sleep(self.args.tg_latency_ms / 1000.0)
+        with self.lock:
+            self.tg_calls[method] = self.tg_calls.get(method, 0) + 1
+            self.tg_message_id += 1
+            mid = self.tg_message_id
+        return {"ok": True, "result": {"message_id": mid}}
+
+    def install(self) -> None:
+        if not self.args.tg_url:
+            self.app.tg = self.fake_tg
+        for lane in self.app.dispatcher.lanes:
+            lane.handler = self._timed(lane.handler)
+
+    def _timed(self, handler):
+        def run(update: dict) -> None:
+            started = time.perf_counter()
+            ok = True
+            try:
+                handler(update)
+            except Exception:
+                ok = False
+                raise
+            finally:
+                done = time.perf_counter()
+                with self.lock:
+                    label, posted = self.pending.pop(int(update.get("update_id", 0)), ("other", started))
+                    self.e2e.setdefault(label, []).append((done - posted) * 1000.0)
+                    self.handle.setdefault(label, []).append((done - started) * 1000.0)
+                    if not ok:
+                        self.handler_errors += 1
+        return run
+
+    # ---- генерация updates ----
+
+    def message(self, uid: int, text: str, chat_id: int = 0, reply_to: int = 0) -> dict:
+        with self.lock:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        m = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id or uid, "type": "supergroup" if chat_id else "private"},
+            "from": {"id": uid, "is_bot": False, "username": f"bench_{uid}", "first_name": "Bench", "last_name": str(uid)},
+            "text": text,
+        }
+        if reply_to:
+            m["reply_to_message"] = {"message_id": reply_to}
+        return {"update_id": update_id, "message": m}
+
+    def post(self, label: str, update: dict) -> None:
+        with self.lock:
+            self.pending[update["update_id"]] = (label, time.perf_counter())
+        resp = self.client.post("/webhook", json=update)
+        if resp.status_code != 200:
+            with self.lock:
+                self.http_errors += 1
+                self.pending.pop(update["update_id"], None)
+
+    def run_phase(self, name: str, streams: Dict[int, List[Tuple[str, dict]]]) -> None:
+        # поток пользователя целиком у одного отправителя: порядок его updates сохраняется
+        buckets: List[List[Tuple[str, dict]]] = [[] for _ in range(max(1, self.args.clients))]
+        total = 0
+        for uid, items in streams.items():
+            buckets[uid % len(buckets)].extend(items)
+            total += len(items)
+        started = time.perf_counter()
+        threads = [threading.Thread(target=lambda b=b: [self.post(label, u) for label, u in b]) for b in buckets]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.app.dispatcher.join()
+        elapsed = time.perf_counter() - started
+        self.phases[name] = {
+            "updates": total,
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+        print(f"{name}: {total} updates in {elapsed:.2f}s", file=sys.stderr)
+
+    def phase_register(self, users: List[int]) -> None:
+        self.run_phase("register", {uid: [("/start", self.message(uid, "/start"))] for uid in users})
+
+    def phase_mixed(self, users: List[int]) -> None:
+        commands = ["/daily", "/profile", "/top", "/queue", "/balance"]
+        submitters = set(self.rnd.sample(users, int(len(users) * self.args.submit_share)))
+        streams: Dict[int, List[Tuple[str, dict]]] = {}
+        for uid in users:
+            items = []
+            for _ in range(self.args.rounds):
+                cmd = self.rnd.choice(commands)
+                items.append((cmd, self.message(uid, cmd)))
+            if uid in submitters:
+                items.append(("/submit", self.message(uid, "/submit")))
+                items.append(("link", self.message(uid, f"https://vk.com/wall-{uid}_{self.rnd.randint(1, 10 ** 6)}")))
+            streams[uid] = items
+        self.run_phase("mixed", streams)
+
+    def phase_duels(self, users: List[int]) -> None:
+        if self.args.duels <= 0 or len(users) < 2:
+            return
+        store = self.app.store
+        initiators = users[:self.args.duels]
+        self.run_phase("duel_start", {uid: [("/duel", self.message(uid, "/duel", chat_id=GROUP_ID))] for uid in initiators})
+
+        duels = [dict(r) for r in store._query_all("SELECT duel_id, announce_message_id FROM duels WHERE status='waiting'")]
+        streams: Dict[int, List[Tuple[str, dict]]] = {}
+        for d in duels:
+            for uid in self.rnd.sample(users, min(len(users), self.args.duel_size)):
+                text = f"Абзац от {uid} для {d['duel_id']}. " * 3
+                streams.setdefault(uid, []).append(
+                    ("duel_reply", self.message(uid, text, chat_id=GROUP_ID, reply_to=int(d["announce_message_id"]))))
+        self.run_phase("duel_replies", streams)
+
+        # дедлайн подачи наступает сразу, как это сделала бы задача duel_submissions
+        for d in duels:
+            self.app.duel_finish_submissions(store.get_duel_by_id(d["duel_id"]))
+        voting = [dict(r) for r in store._query_all(
+            "SELECT duel_id, vote_message_id FROM duels WHERE status='voting' AND vote_message_id IS NOT NULL")]
+        streams = {}
+        for d in voting:
+            entries = len(store.list_duel_entries(d["duel_id"]))
+            for uid in self.rnd.sample(users, min(len(users), self.args.duel_size * 2)):
+                streams.setdefault(uid, []).append(("duel_vote", self.message(
+                    uid, str(self.rnd.randint(1, max(1, entries))), chat_id=GROUP_ID, reply_to=int(d["vote_message_id"]))))
+        self.run_phase("duel_votes", streams)
+        for d in voting:
+            self.app.duel_finish_voting(store.get_duel_by_id(d["duel_id"]))
+
+    def db_bytes(self) -> int:
+        # размер после сброса write-behind и WAL в основной файл, чтобы замеры были сравнимы
+        self.app.store.flush_writes()
+        conn = sqlite3.connect(self.app.DB_PATH)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        return db_size(self.app.DB_PATH)
+
+    def run(self) -> Dict[str, Any]:
+        users = list(range(100000, 100000 + self.args.users))
+        db_path = self.app.DB_PATH
+        size_before = self.db_bytes()
+        started = time.perf_counter()
+
+        self.phase_register(users)
+        elapsed = time.perf_counter() - started
+        size_registered = self.db_bytes()
+        started = time.perf_counter()
+        self.phase_mixed(users)
+        self.phase_duels(users)
+
+        elapsed += time.perf_counter() - started
+        size_after = self.db_bytes()
+        total = sum(p["updates"] for p in self.phases.values())
+
+        return {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": self.app.sqlite3.sqlite_version,
+            "config": {k: v for k, v in vars(self.args).items() if k != "out"},
+            "totals": {
+                "updates": total,
+                "seconds": round(elapsed, 3),
+                "updates_per_sec": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+                "http_errors": self.http_errors,
+                "handler_errors": self.handler_errors,
+                "unfinished": len(self.pending),
+            },
+            "phases": self.phases,
+            # e2e - от POST /webhook до конца обработки, handle - только обработчик
+            "latency_e2e_ms": summarize(self.e2e),
+            "latency_handle_ms": summarize(self.handle),
+            "db": {
+                "path": db_path,
+                "bytes_before": size_before,
+                "bytes_after_register": size_registered,
+                "bytes_after": size_after,
+                "growth_bytes": size_after - size_before,
+                "bytes_per_user": round((size_after - size_before) / max(1, self.args.users), 1),
+                "rows": {t: self.app.store._query_one(f"SELECT COUNT(*) AS c FROM {t}")["c"]
+                         for t in ("users", "submissions", "queue", "duels", "duel_entries", "duel_votes", "processed_updates")},
+            },
+            "telegram_calls": self.tg_calls if not self.args.tg_url else self.app.tg_client.stats(),
+            "queries_per_update": self.app.update_query_stats(),
+            "outbound": self.app.outbound.stats(),
+        }
+
+
+def main() -> int:
+    args = parse_args()
+    configure_env(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    logging.disable(logging.INFO)
+    import app as app_module
+
+    bench = Bench(app_module, args)
+    bench.install()
+    result = bench.run()
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if result["totals"]["http_errors"] or result["totals"]["handler_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,368 @@
+# Локальная заглушка Bot API для проверки исходящего пути без сети.
+#
+#   python fake_telegram.py --port 8081 --latency lognormal:40:0.5 --error-rate 0.01 --rate-429 0.02 --retry-after 2
+#   TELEGRAM_API_BASE=http://127.0.0.1:8081 python app.py        # или bench.py --tg-url http://127.0.0.1:8081
+#
+# Методы: sendMessage, answerCallbackQuery, editMessageText, getUpdates, deleteWebhook (формы ответов как у Telegram).
+# Служебные ручки:
+#   POST /_inject   - положить update (или список) в очередь getUpdates
+#   GET  /_stats    - счетчики по методам/статусам/чатам
+#   POST /_config   - поменять latency/error_rate/rate_429/retry_after/flood_* на лету
+#   POST /_reset    - сбросить счетчики, сообщения и очередь updates
+#
+# Задержка: const:MS | uniform:MIN:MAX | normal:MEAN:SD | lognormal:MEDIAN_MS:SIGMA | exp:MEAN
+# Flood control как у Telegram: --flood-chat-rate (сообщений/сек в личку), --flood-group-per-min (в группы),
+# превышение -> 429 с retry_after до освобождения лимита.
+
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {"id": 777000001, "is_bot": True, "first_name": "FakeClubBot", "username": "fake_clubbot"}
+MAX_STORED_MESSAGES = 100000
+MAX_POLL_TIMEOUT = 50
+
+
+def parse_latency(spec: str):
+    # возвращает функцию без аргументов -> задержка в секундах
+    parts = (spec or "const:0").split(":")
+    kind, args = parts[0].lower(), [float(x) for x in parts[1:]]
+    if kind == "const":
+        ms = args[0] if args else 0.0
+        return lambda: ms / 1000.0
+    if kind == "uniform":
+        lo, hi = args[0], args[1]
+        return lambda: random.uniform(lo, hi) / 1000.0
+    if kind == "normal":
+        mean, sd = args[0], args[1]
+        return lambda: max(0.0, random.gauss(mean, sd)) / 1000.0
+    if kind == "lognormal":
+        median, sigma = args[0], args[1]
+        mu = math.log(max(median, 1e-6))
+        return lambda: random.lognormvariate(mu, sigma) / 1000.0
+    if kind == "exp":
+        mean = args[0]
+        return lambda: random.expovariate(1.0 / mean) / 1000.0 if mean > 0 else 0.0
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class FloodLimiter:
+    # скользящее окно по чату: не больше limit сообщений за window секунд
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent: Dict[int, List[float]] = {}
+
+    def check(self, chat_id: int, limit: float, window: float) -> Optional[int]:
+        if limit <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            times = [t for t in self.sent.get(chat_id, []) if now - t < window]
+            if len(times) >= limit:
+                self.sent[chat_id] = times
+                return max(1, int(math.ceil(window - (now - times[0]))))
+            times.append(now)
+            self.sent[chat_id] = times
+        return None
+
+
+class FakeTelegram:
+    def __init__(self, args: argparse.Namespace):
+        self.token = args.token
+        self.lock = threading.Lock()
+        self.updates_cond = threading.Condition(self.lock)
+        self.flood = FloodLimiter()
+        self.configure(vars(args))
+        self.reset()
+
+    def configure(self, cfg: Dict[str, Any]) -> None:
+        if cfg.get("latency") is not None:
+            self.latency_spec = cfg["latency"]
+            self.latency = parse_latency(self.latency_spec)
+        for key in ("error_rate", "rate_429", "retry_after", "flood_chat_rate", "flood_group_per_min"):
+            if cfg.get(key) is not None:
+                setattr(self, key, float(cfg[key]))
+
+    def config(self) -> Dict[str, Any]:
+        return {"latency": self.latency_spec, "error_rate": self.error_rate, "rate_429": self.rate_429,
+                "retry_after": self.retry_after, "flood_chat_rate": self.flood_chat_rate,
+                "flood_group_per_min": self.flood_group_per_min}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.next_message_id: Dict[int, int] = {}
+            self.messages: "OrderedDict[Tuple[int, int], Dict[str, Any]]" = OrderedDict()
+            self.updates: List[dict] = []
+            self.next_update_id = 1
+            self.by_method: Dict[str, Dict[str, int]] = {}
+            self.by_chat: Dict[int, int] = {}
+            self.latency_total = 0.0
+            self.started = time.time()
+        self.flood = FloodLimiter()
+
+    # ---- учет ----
+
+    def count(self, method: str, status: int, chat_id: Optional[int] = None) -> None:
+        with self.lock:
+            st = self.by_method.setdefault(method, {})
+            st[str(status)] = st.get(str(status), 0) + 1
+            if chat_id is not None and status == 200:
+                self.by_chat[chat_id] = self.by_chat.get(chat_id, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = sum(sum(v.values()) for v in self.by_method.values())
+            elapsed = max(1e-9, time.time() - self.started)
+            top_chats = sorted(self.by_chat.items(), key=lambda kv: kv[1], reverse=True)[:10]
+            return {
+                "config": self.config(),
+                "requests": total,
+                "requests_per_sec": round(total / elapsed, 2),
+                "by_method": self.by_method,
+                "chats": len(self.by_chat),
+                "top_chats": [{"chat_id": c, "delivered": n} for c, n in top_chats],
+                "avg_latency_ms": round(self.latency_total / total * 1000, 2) if total else 0.0,
+                "pending_updates": len(self.updates),
+            }
+
+    # ---- методы Bot API ----
+
+    def _store_message(self, msg: Dict[str, Any]) -> None:
+        self.messages[(msg["chat"]["id"], msg["message_id"])] = msg
+        while len(self.messages) > MAX_STORED_MESSAGES:
+            self.messages.popitem(last=False)
+
+    def send_message(self, p: Dict[str, Any]) -> Tuple[int, dict]:
+        if p.get("chat_id") in (None, "") or not str(p.get("text") or "").strip():
+            return error(400, "Bad Request: message text is empty" if p.get("chat_id") else "Bad Request: chat_id is empty")
+        chat_id = int(p["chat_id"])
+        if chat_id < 0:
+            retry = self.flood.check(chat_id, self.flood_group_per_min, 60.0)
+        else:
+            retry = self.flood.check(chat_id, self.flood_chat_rate, 1.0)
+        if retry is not None:
+            return too_many_requests(retry)
+        with self.lock:
+            mid = self.next_message_id.get(chat_id, 0) + 1
+            self.next_message_id[chat_id] = mid
+            msg = {
+                "message_id": mid,
+                "from": BOT_USER,
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                "date": int(time.time()),
+                "text": str(p["text"]),
+            }
+            if p.get("message_thread_id"):
+                msg["message_thread_id"] = int(p["message_thread_id"])
+                msg["is_topic_message"] = True
+            reply_to = p.get("reply_to_message_id")
+            if reply_to and (chat_id, int(reply_to)) in self.messages:
+                msg["reply_to_message"] = self.messages[(chat_id, int(reply_to))]
+            if p.get("reply_markup"):
+                msg["reply_markup"] = p["reply_markup"] if isinstance(p["reply_markup"], dict) else json.loads(p["reply_markup"])
+            self._store_message(msg)
+        return 200, {"ok": True, "result": msg}
+
+    def edit_message_text(self, p: Dict[str, Any]) -> Tuple[int, dict]:
+        if p.get("inline_message_id"):
+            return 200, {"ok": True, "result": True}
+        try:
+            key = (int(p["chat_id"]), int(p["message_id"]))
+        except (KeyError, TypeError, ValueError):
+            return error(400, "Bad Request: message identifier is not specified")
+        with self.lock:
+            msg = self.messages.get(key)
+            if msg is None:
+                return error(400, "Bad Request: message to edit not found")
+            if msg.get("text") == str(p.get("text")) and not p.get("reply_markup"):
+                return error(400, "Bad Request: message is not modified: specified new message content and reply markup "
+                                  "are exactly the same as a current content and reply markup of the message")
+            msg = dict(msg, text=str(p.get("text")), edit_date=int(time.time()))
+            if p.get("reply_markup"):
+                msg["reply_markup"] = p["reply_markup"] if isinstance(p["reply_markup"], dict) else json.loads(p["reply_markup"])
+            self._store_message(msg)
+        return 200, {"ok": True, "result": msg}
+
+    def answer_callback_query(self, p: Dict[str, Any]) -> Tuple[int, dict]:
+        if not p.get("callback_query_id"):
+            return error(400, "Bad Request: query is too old and response timeout expired or query ID is invalid")
+        return 200, {"ok": True, "result": True}
+
+    def get_updates(self, p: Dict[str, Any]) -> Tuple[int, dict]:
+        offset = int(p.get("offset") or 0)
+        limit = max(1, min(100, int(p.get("limit") or 100)))
+        timeout = max(0.0, min(MAX_POLL_TIMEOUT, float(p.get("timeout") or 0)))
+        deadline = time.monotonic() + timeout
+        with self.updates_cond:
+            # как у Telegram: offset подтверждает все updates с меньшим update_id
+            if offset:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.updates_cond.wait(left)
+            return 200, {"ok": True, "result": self.updates[:limit]}
+
+    def inject(self, body: Any) -> int:
+        items = body if isinstance(body, list) else [body]
+        with self.updates_cond:
+            for upd in items:
+                upd = dict(upd)
+                if "update_id" not in upd:
+                    upd["update_id"] = self.next_update_id
+                self.next_update_id = max(self.next_update_id, int(upd["update_id"]) + 1)
+                self.updates.append(upd)
+            self.updates_cond.notify_all()
+        return len(items)
+
+    def call(self, method: str, params: Dict[str, Any]) -> Tuple[int, dict]:
+        handlers = {
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text,
+            "answerCallbackQuery": self.answer_callback_query,
+            "getUpdates": self.get_updates,
+            "deleteWebhook": lambda p: (200, {"ok": True, "result": True, "description": "Webhook is already deleted"}),
+            "getMe": lambda p: (200, {"ok": True, "result": BOT_USER}),
+        }
+        handler = handlers.get(method)
+        if handler is None:
+            return error(404, "Not Found")
+        # getUpdates не задерживаем и не ломаем: у него своя длинная выдержка
+        if method != "getUpdates":
+            delay = self.latency()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                self.latency_total += delay
+            roll = random.random()
+            if roll < self.rate_429:
+                return too_many_requests(int(self.retry_after))
+            if roll < self.rate_429 + self.error_rate:
+                return error(500, "Internal Server Error")
+        return handler(params)
+
+
+def error(code: int, description: str) -> Tuple[int, dict]:
+    return code, {"ok": False, "error_code": code, "description": description}
+
+
+def too_many_requests(retry_after: int) -> Tuple[int, dict]:
+    retry_after = max(1, int(retry_after))
+    return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                 "parameters": {"retry_after": retry_after}}
+
+
+def make_handler(fake: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у api.telegram.org
+        # заголовки и тело уходят отдельными write: с Nagle + delayed ACK каждый запрос
+        # на keep-alive соединении получал бы лишние ~40 ms поверх заданной задержки
+        disable_nagle_algorithm = True
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _params(self) -> Dict[str, Any]:
+            url = urlparse(self.path)
+            params: Dict[str, Any] = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            ctype = (self.headers.get("Content-Type") or "").split(";")[0].strip()
+            if body and ctype == "application/json":
+                data = json.loads(body.decode("utf-8"))
+                if isinstance(data, dict):
+                    params.update(data)
+                else:
+                    params["_body"] = data
+            elif body and ctype == "application/x-www-form-urlencoded":
+                params.update({k: v[-1] for k, v in parse_qs(body.decode("utf-8")).items()})
+            return params
+
+        def _reply(self, status: int, payload: Any) -> None:
+            raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _handle(self) -> None:
+            path = urlparse(self.path).path
+            try:
+                params = self._params()
+            except ValueError:
+                self._reply(400, {"ok": False, "error_code": 400, "description": "Bad Request: can't parse JSON"})
+                return
+            if path == "/_stats":
+                self._reply(200, fake.stats())
+                return
+            if path == "/_inject":
+                self._reply(200, {"ok": True, "injected": fake.inject(params.get("_body", params))})
+                return
+            if path == "/_config":
+                fake.configure(params)
+                self._reply(200, {"ok": True, "config": fake.config()})
+                return
+            if path == "/_reset":
+                fake.reset()
+                self._reply(200, {"ok": True})
+                return
+
+            parts = path.strip("/").split("/")
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                return
+            token, method = parts[0][3:], parts[1]
+            if fake.token and token != fake.token:
+                fake.count(method, 401)
+                self._reply(401, {"ok": False, "error_code": 401, "description": "Unauthorized"})
+                return
+            status, payload = fake.call(method, params)
+            chat_id = params.get("chat_id")
+            fake.count(method, status, int(chat_id) if method == "sendMessage" and str(chat_id).lstrip("-").isdigit() else None)
+            self._reply(status, payload)
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--token", default="", help="если задан, запросы с другим токеном получают 401")
+    p.add_argument("--latency", default="const:0", help="const:MS | uniform:MIN:MAX | normal:MEAN:SD | lognormal:MEDIAN:SIGMA | exp:MEAN")
+    p.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    p.add_argument("--rate-429", type=float, default=0.0, help="доля случайных ответов 429")
+    p.add_argument("--retry-after", type=float, default=1.0, help="retry_after для случайных 429, сек")
+    p.add_argument("--flood-chat-rate", type=float, default=0.0, help="лимит сообщений/сек в личный чат (0 - выкл)")
+    p.add_argument("--flood-group-per-min", type=float, default=0.0, help="лимит сообщений/мин в группу (0 - выкл)")
+    return p.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    fake = FakeTelegram(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    server.daemon_threads = True
+    print(f"fake Bot API on http://{args.host}:{args.port} ({json.dumps(fake.config())})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(fake.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()